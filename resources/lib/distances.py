@@ -0,0 +1,161 @@
+import os
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.distance import cdist
+from local.utils import n_threads
+
+_POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _popcount_sum(x: np.ndarray) -> np.ndarray:
+    # number of set bits along the last axis of a uint64 array
+    if hasattr(np, "bitwise_count"): # numpy >= 2.0
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_LUT[x.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def _popcount_block_size(n_words: int) -> int:
+    # rows per side of a square block, so that the (block, block, words) intermediate stays around 32 MB
+    return int(max(8, min(512, np.sqrt(2**22/max(n_words, 1)))))
+
+def PackBits(b: np.ndarray) -> np.ndarray:
+    """
+    rows of a boolean matrix as uint64 words, zero padded
+    """
+    packed = np.packbits(b, axis=1)
+    pad = -packed.shape[1] % 8
+    if pad > 0: packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+def CondensedIndex(n: int, i, j):
+    """
+    position of pair (i, j), i < j, in a condensed distance vector as made by scipy's pdist
+    """
+    return n*i - i*(i+1)//2 + (j-i-1)
+
+def ScratchBuffer(size: int, dtype=np.float32, scratch_dir: str|None=None) -> np.ndarray:
+    """
+    a disk-backed array, so that large intermediates are paged by the OS instead of held in RAM
+    the file is unlinked right away and disappears with the array
+    scratch_dir: defaults to $TMPDIR
+    """
+    if size == 0: return np.empty(0, dtype=dtype) # can't map an empty file
+    fd, path = tempfile.mkstemp(suffix=".buf", dir=scratch_dir)
+    try:
+        os.ftruncate(fd, size*np.dtype(dtype).itemsize)
+        buf = np.memmap(path, dtype=dtype, mode="r+", shape=(size,))
+    finally:
+        os.close(fd)
+        os.remove(path)
+    return buf
+
+def _jaccard_block(wa: np.ndarray, ones_a: np.ndarray, wb: np.ndarray, ones_b: np.ndarray) -> np.ndarray:
+    # all pairs between two blocks of packed rows
+    inter = _popcount_sum(wa[:, None, :] & wb[None, :, :])
+    union = ones_a[:, None] + ones_b[None, :] - inter
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(union > 0, 1 - inter/union, 0).astype(np.float32)
+
+def JaccardDistance(b: np.ndarray, block_size: int|None=None, threads: int|None=None, packed=False, out: np.ndarray|None=None) -> np.ndarray:
+    """
+    Jaccard distances between the rows of boolean matrix [b],
+    as a float32 condensed vector (see scipy's pdist), so it can be given to
+    HierarchicalCluster(..., metric="precomputed") directly
+
+    rows are packed to bits once, then intersections are counted with popcount
+    in square blocks of [block_size] rows, spread over [threads]
+    packed: [b] is already the output of PackBits()
+    out: write into this instead, e.g. a ScratchBuffer
+    pairs of empty rows have a distance of 0, same as scipy
+    """
+    words = b if packed else PackBits(b)
+    n, n_words = words.shape
+    ones = _popcount_sum(words)
+    if out is None: out = np.empty(n*(n-1)//2, dtype=np.float32)
+    if block_size is None: block_size = _popcount_block_size(n_words)
+
+    def _rows(i0: int):
+        i1 = min(i0+block_size, n)
+        for j0 in range(i0, n, block_size):
+            j1 = min(j0+block_size, n)
+            d = _jaccard_block(words[i0:i1], ones[i0:i1], words[j0:j1], ones[j0:j1])
+            for i in range(i0, i1):
+                js = max(j0, i+1)
+                if js >= j1: continue
+                k = CondensedIndex(n, i, js)
+                out[k:k+j1-js] = d[i-i0, js-j0:]
+
+    with ThreadPoolExecutor(threads or n_threads()) as pool:
+        for _ in pool.map(_rows, range(0, n, block_size)): pass
+    return out
+
+def ColumnJaccardDistance(m: np.ndarray, block_rows: int=1<<16) -> np.ndarray:
+    """
+    Jaccard distances between the columns of [m], where nonzero is present,
+    as a float32 condensed vector, same as JaccardDistance(m.T > 0)
+    intersections are summed over blocks of rows as matrix products,
+    so [m] may be memory-mapped and no full size copy of it is made
+    """
+    k = m.shape[1]
+    inter = np.zeros((k, k))
+    for i0 in range(0, len(m), block_rows):
+        b = (m[i0:i0+block_rows] > 0).astype(np.float32) # exact, as blocks are shorter than 2^24
+        inter += b.T @ b
+    ones = np.diag(inter)
+    union = ones[:, None] + ones[None, :] - inter
+    with np.errstate(invalid="ignore", divide="ignore"):
+        d = np.where(union > 0, 1 - inter/union, 0)
+    i, j = np.triu_indices(k, k=1)
+    return d[i, j].astype(np.float32)
+
+def CondensedDistance(Z: np.ndarray, metric="euclidean", block_rows: int|None=None, out: np.ndarray|None=None, scratch_dir: str|None=None) -> np.ndarray:
+    """
+    float32 condensed distances between the rows of [Z], same as pdist, but computed
+    a block of rows at a time straight into [out], a ScratchBuffer unless given
+    so that only the output, which may be memory-mapped, grows with n^2
+    jaccard on boolean matrices uses the popcount kernel
+    """
+    n = len(Z)
+    if out is None: out = ScratchBuffer(n*(n-1)//2, scratch_dir=scratch_dir)
+    if metric == "jaccard" and Z.dtype == bool:
+        return JaccardDistance(Z, out=out)
+    if block_rows is None: # keep the float64 block from cdist around 32 MB
+        block_rows = max(1, 2**22//max(n, 1))
+    for i0 in range(0, n, block_rows):
+        i1 = min(i0+block_rows, n)
+        d = cdist(Z[i0:i1], Z[i0:], metric=metric)
+        for i in range(i0, i1):
+            if i+1 >= n: continue
+            k = CondensedIndex(n, i, i+1)
+            out[k:k+n-i-1] = d[i-i0, i-i0+1:]
+    return out
+
+def CrossDistance(A: np.ndarray, B: np.ndarray, metric="euclidean", block_size: int|None=None) -> np.ndarray:
+    """
+    distances from every row of [A] to every row of [B], same as cdist, but in float32
+    jaccard on boolean matrices uses the popcount kernel
+    """
+    out = np.empty((len(A), len(B)), dtype=np.float32)
+    if metric == "jaccard" and A.dtype == bool and B.dtype == bool:
+        wa, wb = PackBits(A), PackBits(B)
+        oa, ob = _popcount_sum(wa), _popcount_sum(wb)
+        if block_size is None: block_size = _popcount_block_size(wa.shape[1])
+        for i0 in range(0, len(A), block_size):
+            for j0 in range(0, len(B), block_size):
+                i1, j1 = i0+block_size, j0+block_size
+                out[i0:i1, j0:j1] = _jaccard_block(wa[i0:i1], oa[i0:i1], wb[j0:j1], ob[j0:j1])
+        return out
+    if block_size is None: # keep the float64 block from cdist around 32 MB
+        block_size = max(1, 2**22//max(len(B), 1))
+    if metric in {"euclidean", "sqeuclidean"}: # |a|^2 + |b|^2 - 2ab, as a matrix product
+        dtype = np.float32 if A.dtype == bool and A.shape[1] < 2**24 else np.float64 # exact for 0/1 rows
+        B = B.astype(dtype)
+        bb = np.einsum("ij,ij->i", B, B)
+        for i0 in range(0, len(A), block_size):
+            a = A[i0:i0+block_size].astype(dtype)
+            d = np.einsum("ij,ij->i", a, a)[:, None] + bb[None, :] - 2*(a @ B.T)
+            np.maximum(d, 0, out=d)
+            out[i0:i0+block_size] = np.sqrt(d) if metric == "euclidean" else d
+        return out
+    for i0 in range(0, len(A), block_size):
+        out[i0:i0+block_size] = cdist(A[i0:i0+block_size], B, metric=metric)
+    return out
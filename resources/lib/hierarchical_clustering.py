@@ -1,9 +1,15 @@
 from __future__ import annotations
 import numpy as np
-from typing import Any
-from dataclasses import dataclass
-from scipy.cluster.hierarchy import linkage, dendrogram
-from scipy.spatial.distance import squareform
+import resource
+from functools import partial
+from pathlib import Path
+from collections.abc import Mapping, Sequence
+from dataclasses import dataclass, field
+from collections import deque
+from scipy.cluster.hierarchy import linkage, cophenet, optimal_leaf_ordering
+from scipy.spatial.distance import squareform, pdist
+from distances import CondensedDistance, CondensedIndex, CrossDistance, ScratchBuffer
+from local.caching import cache
 
 @dataclass
 class LabelGroup[T]:
@@ -17,27 +23,98 @@ class LabelGroup[T]:
     def GetAny(self):
         return self.group[0]
     
-def Deduplicate(z: np.ndarray, labels: list):
-    row_groups = {}
-    for i, row in enumerate(z):
-        label = labels[i]
-        k = tuple(row)
-        row_groups[k] = row_groups.get(k, [])+[(label, i)]
-    unique_rows = [g[0][1] for g in row_groups.values()]
-    z = z[unique_rows]
-    ulabels = [LabelGroup(index=i, group=[l for l, i in g], groupi=[i for l, i in g]) for i, g in enumerate(row_groups.values())]
-    return z, ulabels
+class LabelGroups[T](Sequence):
+    """
+    groups of identical rows in CSR layout,
+    the original row indices of group g are indices[indptr[g]:indptr[g+1]]
+    LabelGroup objects are only made when a group is accessed
+    """
+    def __init__(self, labels: list[T], indptr: np.ndarray, indices: np.ndarray) -> None:
+        self.labels = labels
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr)-1
+
+    def __getitem__(self, g):
+        if isinstance(g, slice): return [self[i] for i in range(*g.indices(len(self)))]
+        if g < 0: g += len(self)
+        if not 0 <= g < len(self): raise IndexError(g)
+        groupi = self.indices[self.indptr[g]:self.indptr[g+1]].tolist()
+        return LabelGroup(group=[self.labels[i] for i in groupi], groupi=groupi, index=g)
+
+    def Sizes(self):
+        return np.diff(self.indptr)
+
+def Deduplicate(z: np.ndarray, labels: list, packed: np.ndarray|None=None):
+    """
+    groups identical rows of [z], groups are numbered by their first occurrence
+    returns the first row of each group and the groups
+    packed: rows to compare instead of [z], such as presence bitsets from pangenome_matrix.ReadMatrix
+    """
+    # boolean rows are packed to bits, then each row is compared as a single opaque value
+    rows = packed if packed is not None else np.packbits(z, axis=1) if z.dtype == bool else z
+    rows = np.ascontiguousarray(rows)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize*rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    by_first = np.argsort(first)
+    rank = np.empty_like(by_first)
+    rank[by_first] = np.arange(len(first))
+    group = rank[inverse.ravel()]
+    indices = np.argsort(group, kind="stable")
+    indptr = np.zeros(len(first)+1, dtype=np.int64)
+    np.cumsum(np.bincount(group, minlength=len(first)), out=indptr[1:])
+    return z[first[by_first]], LabelGroups(labels, indptr, indices)
+
+class DendrogramNode:
+    """
+    a view of node [i] of a LinkageResult, made on demand
+    """
+    __slots__ = ("result", "i")
+    def __init__(self, result: LinkageResult, i: int) -> None:
+        self.result = result
+        self.i = i
+
+    @property
+    def x(self) -> float:
+        return float(self.result.x[self.i])
+
+    @property
+    def y(self) -> float:
+        return float(self.result.y[self.i])
+
+    @property
+    def name(self):
+        return self.result.names[self.i] if self.IsLeaf() else None
+
+    @property
+    def left(self):
+        return self._node(self.result.left[self.i])
+
+    @property
+    def right(self):
+        return self._node(self.result.right[self.i])
+
+    @property
+    def parent(self):
+        return self._node(self.result.parent[self.i])
+
+    def _node(self, i):
+        return None if i < 0 else DendrogramNode(self.result, int(i))
+
+    def __eq__(self, other):
+        return isinstance(other, DendrogramNode) and other.result is self.result and other.i == self.i
+
+    def __hash__(self):
+        return hash((id(self.result), self.i))
+
+    def __repr__(self):
+        return f"DendrogramNode(i={self.i}, x={self.x}, y={self.y})"
 
-@dataclass
-class DendrogramNode[T]:
-    x: float
-    y: float
-    i: int
-    name: T|None=None
-    left: DendrogramNode[T]|None=None
-    right: DendrogramNode[T]|None=None
     def IsLeaf(self):
-        return self.left is None and self.right is None
+        return self.result.left[self.i] < 0
     
     def Children(self):
         for c in [self.left, self.right]:
@@ -45,203 +122,466 @@ class DendrogramNode[T]:
                 yield c
 
     def Traverse(self, order="in"):
-        if self.IsLeaf():
-            yield self
+        """
+        order: [pre, in, post, level]
+        uses an explicit stack, so depth is not limited by the recursion limit
+        """
+        if order == "level":
+            queue = deque([self])
+            while len(queue) > 0:
+                node = queue.popleft()
+                yield node
+                queue.extend(node.Children())
             return
-        
-        left, right = self.Children()
-        todo = {
-            "pre": [self, left, right],
-            "in": [left, self, right],
-            "post": [left, right, self]
-        }[order]
-        for x in todo:
-            if x == self:
-                yield self
-            else:
-                yield from x.Traverse(order)
+
+        assert order in {"pre", "in", "post"}, order
+        stack: list[tuple[DendrogramNode, bool]] = [(self, False)]
+        while len(stack) > 0:
+            node, expanded = stack.pop()
+            if expanded or node.IsLeaf():
+                yield node
+                continue
+            children = list(node.Children())
+            todo = {
+                "pre": [node]+children,
+                "in": children[:1]+[node]+children[1:],
+                "post": children+[node],
+            }[order]
+            for x in reversed(todo):
+                stack.append((x, x is node))
     
 @dataclass
 class LinkageResult[T]:
-    labels: list[T]
-    order: list[int]
-    mat: np.ndarray
-    tree: DendrogramNode
+    """
+    a dendrogram as arrays indexed by node id: leaves are 0..n-1 and the merge in row r of [linkage] is node n+r
+    left, right and parent are -1 where there is no such node, x and y are scaled to [0, 1]
+    names: the label of each leaf, by leaf id
+    order: leaf ids from left to right
+    """
+    names: Sequence[T]
+    order: np.ndarray
+    linkage: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
     root_distance: float
-    linkage: Any
+    peak_memory: int|None = None
+    quality: float|None = None
+    parent: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        n = len(self.order)
+        self.parent = np.full(len(self.left), -1, dtype=np.int64)
+        self.parent[self.left[n:]] = np.arange(n, len(self.left))
+        self.parent[self.right[n:]] = np.arange(n, len(self.left))
+
+    @property
+    def labels(self) -> list[T]:
+        # leaf labels from left to right
+        return [self.names[i] for i in self.order.tolist()]
+
+    @property
+    def tree(self) -> DendrogramNode:
+        return DendrogramNode(self, len(self.left)-1)
+
+    def Reorder(self, Z: np.ndarray, precomputed=False):
+        """
+        the rows of [Z] in leaf order, and the columns too if [Z] is a square distance matrix
+        """
+        Z = Z[self.order]
+        if precomputed: Z = Z[:, self.order]
+        return Z
+
+    def ToArrays(self) -> dict[str, np.ndarray]:
+        """
+        named arrays, for Save() or cache(..., backend="array")
+        labels are included if they are all str or all int, otherwise give them to FromArrays()
+        """
+        arrays = dict(
+            order=self.order, linkage=self.linkage,
+            left=self.left, right=self.right, x=self.x, y=self.y,
+            root_distance=np.asarray(self.root_distance),
+            peak_memory=np.asarray(-1 if self.peak_memory is None else self.peak_memory),
+            quality=np.asarray(np.nan if self.quality is None else self.quality),
+        )
+        if not isinstance(self.names, LabelGroups):
+            kinds = {type(l) for l in self.names}
+            if kinds == {str} or kinds == {int}: arrays["names"] = np.array(self.names)
+        return arrays
+
+    @classmethod
+    def FromArrays(cls, arrays: Mapping[str, np.ndarray], labels: Sequence|None=None) -> LinkageResult:
+        if labels is None:
+            labels = arrays["names"].tolist() if "names" in arrays else list(range(len(arrays["order"])))
+        peak, quality = int(arrays["peak_memory"]), float(arrays["quality"])
+        return cls(
+            labels, arrays["order"], arrays["linkage"], arrays["left"], arrays["right"], arrays["x"], arrays["y"], float(arrays["root_distance"]),
+            peak_memory=None if peak < 0 else peak,
+            quality=None if np.isnan(quality) else quality,
+        )
+
+    def Save(self, path: str|Path):
+        # a single .npz, see ToArrays()
+        with open(path, "wb") as f:
+            np.savez(f, **self.ToArrays())
+
+    @classmethod
+    def Load(cls, path: str|Path, labels: Sequence|None=None) -> LinkageResult:
+        with np.load(path, allow_pickle=False) as f:
+            return cls.FromArrays({k: f[k] for k in f.files}, labels)
+
+def _LinkageTree(linkage_data: np.ndarray, count_sort=False, distance_sort=False):
+    """
+    the dendrogram of a scipy linkage matrix in linear time, without scipy's dendrogram()
+    node ids follow scipy: leaves are 0..n-1 and the merge in row r is node n+r
+    coordinates match dendrogram(): leaves at x=5, 15, 25, ... in leaf order,
+    merges centered over their children at the height of the merge
+    returns left, right, x, y (indexed by node id, -1 for the children of leaves) and the leaf order
+    """
+    n = len(linkage_data)+1
+    a = linkage_data[:, 0].astype(np.int64)
+    b = linkage_data[:, 1].astype(np.int64)
+    counts = np.concatenate([np.ones(n), linkage_data[:, 3]])
+    heights = np.concatenate([np.zeros(n), linkage_data[:, 2]])
+
+    # which child is drawn on the left, same rules as dendrogram()
+    if count_sort in [True, "ascending"]:
+        swap = counts[a] > counts[b]
+    elif count_sort == "descending":
+        swap = ~(counts[a] > counts[b])
+    elif distance_sort in [True, "ascending"]:
+        swap = heights[a] > heights[b]
+    elif distance_sort == "descending":
+        swap = ~(heights[a] > heights[b])
+    else:
+        swap = np.zeros(n-1, dtype=bool)
+    left = np.full(2*n-1, -1, dtype=np.int64)
+    right = np.full(2*n-1, -1, dtype=np.int64)
+    left[n:] = np.where(swap, b, a)
+    right[n:] = np.where(swap, a, b)
 
-def HierarchicalCluster(Z: np.ndarray, labels: list|None = None, method="ward", metric="euclidean", distance_sort=False, count_sort=False, sort_order=None) -> LinkageResult:
+    # leaf order, by depth first search from the root
+    order = np.empty(n, dtype=np.int64)
+    k = 0
+    todo = [2*n-2]
+    while len(todo) > 0:
+        i = todo.pop()
+        if i < n:
+            order[k] = i
+            k += 1
+        else:
+            todo.append(right[i])
+            todo.append(left[i])
+
+    xs = np.empty(2*n-1)
+    xs[order] = 5+10*np.arange(n)
+    for i in range(n, 2*n-1): # children always come before their parent
+        xs[i] = (xs[left[i]]+xs[right[i]])/2
+    return left, right, xs, heights, order
+
+def _NNChainLinkage(D: np.ndarray, n: int, method: str) -> np.ndarray:
+    """
+    nearest-neighbour-chain clustering on condensed distances [D], which are overwritten
+    with Lance-Williams updates, so nothing beyond [D] grows with n^2 and [D] may be memory-mapped
+    returns a linkage matrix in scipy's format
+    """
+    if method not in {"single", "complete", "average", "weighted", "ward"}:
+        raise ValueError(f"[{method}] is not reducible, so it can't be used with the nearest-neighbour chain")
+    k = np.arange(n, dtype=np.int64)
+    def _index(x: int):
+        lo, hi = np.minimum(k, x), np.maximum(k, x)
+        idx = n*lo - lo*(lo+1)//2 + (hi-lo-1)
+        idx[x] = 0
+        return idx
+
+    size = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    merges = np.empty((n-1, 3))
+    chain: list[int] = []
+    for step in range(n-1):
+        if len(chain) == 0: chain.append(int(np.argmax(active)))
+        while True:
+            x = chain[-1]
+            row = D[_index(x)].astype(np.float64)
+            row[~active] = np.inf
+            row[x] = np.inf
+            y = int(np.argmin(row))
+            if len(chain) > 1 and row[chain[-2]] <= row[y]: # prefer the previous link on ties
+                y = chain[-2]
+                break
+            chain.append(y)
+        chain.pop(); chain.pop()
+        d_xy = row[y]
+        if x > y: # the merged cluster takes the larger slot, same convention as scipy/fastcluster
+            x, y = y, x
+            row = D[_index(x)].astype(np.float64)
+        merges[step] = x, y, d_xy
+
+        idx_y = _index(y)
+        dx, dy = row, D[idx_y].astype(np.float64)
+        nx, ny = size[x], size[y]
+        if method == "single":
+            new = np.minimum(dx, dy)
+        elif method == "complete":
+            new = np.maximum(dx, dy)
+        elif method == "average":
+            new = (nx*dx + ny*dy)/(nx+ny)
+        elif method == "weighted":
+            new = (dx + dy)/2
+        else: # ward
+            t = size+nx+ny
+            new = np.sqrt(np.maximum(((size+nx)*dx**2 + (size+ny)*dy**2 - size*d_xy**2)/t, 0))
+        active[x] = False
+        _k = active.copy()
+        _k[y] = False
+        D[idx_y[_k]] = new[_k]
+        size[y] = nx+ny
+
+    # relabel in order of distance, as scipy does
+    order = np.argsort(merges[:, 2], kind="mergesort")
+    parent = np.arange(2*n-1)
+    csize = np.concatenate([np.ones(n), np.zeros(n-1)])
+    def _find(i):
+        root = i
+        while parent[root] != root: root = parent[root]
+        while parent[i] != root: parent[i], i = root, parent[i]
+        return root
+    linkage_data = np.empty((n-1, 4))
+    for r, m in enumerate(order):
+        x, y, d = merges[m]
+        a, b = _find(int(x)), _find(int(y))
+        c = n+r
+        csize[c] = csize[a]+csize[b]
+        parent[a] = parent[b] = c
+        linkage_data[r] = min(a, b), max(a, b), d, csize[c]
+    return linkage_data
+
+def _Representatives(Z: np.ndarray, k: int, metric: str, seeding: str, rng: np.random.Generator) -> np.ndarray:
+    """
+    sorted row indices of up to [k] representatives of [Z]
+    kmeans++: D^2 seeding over a random pool of 10k rows, so the cost doesn't grow with len(Z)
+    random: a uniform sample
+    """
+    n = len(Z)
+    if seeding == "random":
+        return np.sort(rng.choice(n, k, replace=False))
+    assert seeding == "kmeans++", seeding
+    pool = np.sort(rng.choice(n, min(n, 10*k), replace=False))
+    P = Z[pool]
+    chosen = [int(rng.integers(len(pool)))]
+    nearest = CrossDistance(P, P[chosen], metric)[:, 0].astype(np.float64)
+    for _ in range(k-1):
+        w = nearest**2
+        total = w.sum()
+        if total <= 0: break # the rest of the pool duplicates what was chosen
+        c = int(rng.choice(len(pool), p=w/total))
+        chosen.append(c)
+        np.minimum(nearest, CrossDistance(P, P[[c]], metric)[:, 0], out=nearest)
+    return np.sort(pool[chosen])
+
+def _AssignNearest(Z: np.ndarray, reps: np.ndarray, metric: str) -> np.ndarray:
+    # index into [reps] of the nearest representative of each row, in batches of ~16 MB of distances
+    assign = np.empty(len(Z), dtype=np.int64)
+    R = Z[reps]
+    batch = max(1, 2**22//len(reps))
+    for i0 in range(0, len(Z), batch):
+        assign[i0:i0+batch] = np.argmin(CrossDistance(Z[i0:i0+batch], R, metric), axis=1)
+    assign[reps] = np.arange(len(reps))
+    return assign
+
+def _ExpandLinkage(rep_linkage: np.ndarray, reps: np.ndarray, assign: np.ndarray) -> np.ndarray:
+    """
+    linkage over all rows from a linkage over the representatives:
+    each representative first takes in its assigned rows as a chain at height 0,
+    then the chains are joined as in [rep_linkage]
+    """
+    n, k = len(assign), len(reps)
+    is_rep = np.zeros(n, dtype=bool)
+    is_rep[reps] = True
+    members = np.flatnonzero(~is_rep)
+    members = members[np.argsort(assign[members], kind="stable")]
+    m = len(members)
+    group = assign[members]
+    sizes = np.bincount(group, minlength=k)
+    starts = np.cumsum(sizes)-sizes
+    t = np.arange(m)-starts[group] # position in its chain
+    prev = np.where(t == 0, reps[group], n+np.arange(m)-1)
+
+    linkage_data = np.empty((n-1, 4))
+    linkage_data[:m, 0] = np.minimum(prev, members)
+    linkage_data[:m, 1] = np.maximum(prev, members)
+    linkage_data[:m, 2] = 0
+    linkage_data[:m, 3] = t+2
+
+    # node ids of the representatives' linkage, in the full linkage
+    node = np.concatenate([np.where(sizes > 0, n+starts+sizes-1, reps), n+m+np.arange(k-1)])
+    a = node[rep_linkage[:, 0].astype(np.int64)]
+    b = node[rep_linkage[:, 1].astype(np.int64)]
+    counts = np.concatenate([sizes+1, np.zeros(k-1)])
+    for r, (x, y) in enumerate(rep_linkage[:, :2].astype(np.int64)):
+        counts[k+r] = counts[x]+counts[y]
+    linkage_data[m:, 0] = np.minimum(a, b)
+    linkage_data[m:, 1] = np.maximum(a, b)
+    linkage_data[m:, 2] = rep_linkage[:, 2]
+    linkage_data[m:, 3] = counts[k:]
+    return linkage_data
+
+def _CopheneticAgreement(Z: np.ndarray, rep_linkage: np.ndarray, assign: np.ndarray, method: str, metric: str, sample: int, rng: np.random.Generator) -> float:
+    """
+    correlation between the cophenetic distances of the approximate tree and
+    those of an exact clustering, over all pairs in a random sample of rows
+    """
+    s = np.sort(rng.choice(len(Z), min(sample, len(Z)), replace=False))
+    exact = cophenet(linkage(Z[s], method=method, metric=metric))
+    rep_coph = squareform(cophenet(rep_linkage)) # 0 between rows of the same representative
+    a = assign[s]
+    i, j = np.triu_indices(len(s), k=1)
+    return float(np.corrcoef(exact, rep_coph[a[i], a[j]])[0, 1])
+
+def _OptimalLeafOrdering(linkage_data: np.ndarray, Z: np.ndarray, metric: str, max_size: int) -> np.ndarray:
+    """
+    scipy's optimal_leaf_ordering, which is O(n^3), applied separately to
+    each largest subtree of at most [max_size] leaves, the order above them is kept
+    [Z] is as given to linkage(), the condensed distances if precomputed
+    returns the linkage with the children of some rows swapped
+    """
+    n = len(linkage_data)+1
+    out = linkage_data.copy()
+    a = linkage_data[:, 0].astype(np.int64)
+    b = linkage_data[:, 1].astype(np.int64)
+    counts = np.concatenate([np.ones(n), linkage_data[:, 3]])
+    parent = np.full(2*n-1, -1, dtype=np.int64)
+    parent[a] = parent[b] = np.arange(n, 2*n-1)
+    small = counts <= max_size
+    roots = np.flatnonzero(small & ((parent < 0) | ~small[parent]) & (counts > 2))
+    for root in roots:
+        nodes, todo = [], [int(root)]
+        while len(todo) > 0:
+            i = todo.pop()
+            nodes.append(i)
+            if i >= n: todo += [a[i-n], b[i-n]]
+        nodes = np.sort(nodes) # leaves, then merges with children before parents
+        leaves, rows = nodes[nodes < n], nodes[nodes >= n]-n
+        local = np.empty(2*n-1, dtype=np.int64)
+        local[nodes] = np.arange(len(nodes))
+        sub = linkage_data[rows].copy()
+        sub[:, 0], sub[:, 1] = local[a[rows]], local[b[rows]]
+
+        if metric != "precomputed":
+            d = pdist(Z[leaves], metric=metric)
+        else:
+            i, j = np.triu_indices(len(leaves), k=1)
+            d = Z[CondensedIndex(n, leaves[i], leaves[j])]
+        ordered = optimal_leaf_ordering(sub, d.astype(np.float64))
+        swapped = rows[ordered[:, 0] != sub[:, 0]]
+        out[swapped, 0], out[swapped, 1] = linkage_data[swapped, 1], linkage_data[swapped, 0]
+    return out
+
+def _SortSubtrees(left: np.ndarray, right: np.ndarray, linkage_data: np.ndarray, sort_order) -> np.ndarray:
+    """
+    places each node at the mean [sort_order] of its leaves, from subtree sums and sizes,
+    and swaps [left] and [right] in place so that the lower side is on the left
+    returns x by node id
+    """
+    n = len(linkage_data)+1
+    sums = np.concatenate([np.asarray(sort_order, dtype=np.float64), np.zeros(n-1)]).tolist()
+    _left, _right = left.tolist(), right.tolist()
+    for i in range(n, 2*n-1): # children always come before their parent
+        sums[i] = sums[_left[i]] + sums[_right[i]]
+    xs = np.array(sums)/np.concatenate([np.ones(n), linkage_data[:, 3]])
+    swap = n+np.flatnonzero(xs[left[n:]] > xs[right[n:]])
+    left[swap], right[swap] = right[swap], left[swap]
+    return xs
+
+def _Normalize(v: np.ndarray):
+    return (v - v.min()) / (v.max() - v.min())
+
+def PeakMemory():
+    # peak resident set size of this process, in bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def HierarchicalCluster(Z: np.ndarray, labels: list|None = None, method="ward", metric="euclidean", distance_sort=False, count_sort=False, sort_order=None,
+    optimal_ordering=False, max_ordering_size=1000,
+    mode="exact", scratch_dir: str|None=None,
+    n_representatives=2000, seeding="kmeans++", quality_sample=1000, seed=0) -> LinkageResult:
     """
     method: [single, complete, average, weighted, centroid, median, ward]
     https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html
     
     metric: https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.pdist.html#scipy.spatial.distance.pdist 
-    """
-    class FloatDict[U]:
-        def __init__(self, d: dict[float, U] = dict()):
-            self.d = d
-            self.index = sorted(list(d.keys()))
-
-        def _binary_search(self, k: float):
-            # binary search for the nearest key to account for floating point errors
-            l, r = 0, len(self.index)-1
-            while l < r:
-                m = (l + r) // 2
-                if self.index[m] < k:
-                    l = m + 1
-                else:
-                    r = m
-            return self.index[l]
-
-        def Nearest(self, k: float):
-            if k in self.d: return self.d[k]
-            return self.d[self._binary_search(k)]
-
-    @dataclass
-    class _DendNode:
-        x: float
-        y: float
-        i: int
-        xs: tuple[float, float, float, float]
-        ys: tuple[float, float, float, float]
-        left: _DendNode|None
-        right: _DendNode|None
-
-        def __hash__(self) -> int:
-            return self.i
-        def IsLeaf(self):
-            return self.left is None and self.right is None
-        def LeftCoords(self):
-            (x1, x2, x3, x4), (y1, y2, y3, y4) = self.xs, self.ys
-            return x1, y1
-        def RightCoords(self):
-            (x1, x2, x3, x4), (y1, y2, y3, y4) = self.xs, self.ys
-            return x4, y4
-        def IsAt(self, x, y):
-            if x == self.x and y == self.y: return True
-            zero = 1.0e-4
-            return abs(self.x - x) < zero and abs(self.y - y) < zero
+        precomputed: [Z] is a square distance matrix, or a condensed one such as from pdist or distances.JaccardDistance
 
-    # ###############################################################
-    # use scipy to do the clustering
-    labels = list(labels) if labels is not None else list(range(Z.shape[0]))
+    optimal_ordering: flip subtrees so that neighbouring leaves are as similar as possible, see scipy's optimal_leaf_ordering,
+        done within each subtree of up to [max_ordering_size] leaves, and cached by the linkage and [Z]
+        instead of distance_sort, count_sort and sort_order
+
+    mode:
+        exact: scipy's linkage
+        large: float32 distances computed in chunks into a memory-mapped buffer in [scratch_dir],
+            clustered with a nearest-neighbour chain, for [single, complete, average, weighted, ward]
+            peak memory is printed and kept in the result
+        approximate: clusters [n_representatives] rows exactly, picked by [seeding] (kmeans++ or random),
+            then hangs every other row at height 0 under its nearest representative
+            the agreement with an exact clustering of [quality_sample] random rows,
+            as the correlation of cophenetic distances, is printed and kept in the result
+    """
+    assert mode in {"exact", "large", "approximate"}, mode
+    if mode == "approximate":
+        assert metric != "precomputed", "approximate mode needs the rows, not their distances"
+        if len(Z) <= n_representatives: mode = "exact"
+    condensed = metric=="precomputed" and Z.ndim == 1
+    n = int(np.ceil(np.sqrt(2*len(Z)))) if condensed else Z.shape[0]
+    names = labels if labels is not None else list(range(n))
     _Z = Z
-    if metric=="precomputed": _Z = squareform(Z)
-    linkage_data = linkage(_Z, method=method, metric=metric, optimal_ordering=False)
-    _p: Any = dict(count_sort=count_sort, distance_sort=distance_sort) # to bypass type warning
-    dend = dendrogram(linkage_data, no_plot=True, labels=list(range(len(labels))), **_p)
+    if metric=="precomputed" and not condensed: _Z = squareform(Z)
+    if mode == "large":
+        D = ScratchBuffer(n*(n-1)//2, scratch_dir=scratch_dir)
+        if metric=="precomputed":
+            D[:] = _Z # the chain overwrites its input
+        else:
+            CondensedDistance(Z, metric=metric, out=D)
+        linkage_data = _NNChainLinkage(D, n, method)
+        del D
+    elif mode == "approximate":
+        rng = np.random.default_rng(seed)
+        reps = _Representatives(Z, n_representatives, metric, seeding, rng)
+        rep_linkage = linkage(Z[reps], method=method, metric=metric, optimal_ordering=False)
+        assign = _AssignNearest(Z, reps, metric)
+        linkage_data = _ExpandLinkage(rep_linkage, reps, assign)
+    else:
+        linkage_data = linkage(_Z, method=method, metric=metric, optimal_ordering=False)
+
+    if optimal_ordering:
+        assert not (distance_sort or count_sort or sort_order is not None), "optimal_ordering replaces the other orderings"
+        # keyed by the partial's arguments, a lambda would have its closure hashed on top of the inputs
+        linkage_data = cache(
+            "optimal_leaf_ordering", partial(_OptimalLeafOrdering, linkage_data, _Z, metric, max_ordering_size),
+            inputs=[], backend="array",
+        )
 
     # ###############################################################
-    # convert the arrays of inscrutible numbers and unhelpful tree
-    # tree structure from scipy into something useful 
-    link_ys = dend["dcoord"]
-    link_xs = dend["icoord"]
-    clust_orderi = dend["ivl"]
-    clust_order = [labels[i] for i in clust_orderi]
-
-    _nodes_by_x = {}
-    _nodes_by_y = {}
-    nodes_by_i: dict[int, _DendNode] = {}
-    nodes: list[_DendNode] = []
-    for i, (xs, ys) in enumerate(zip(link_xs, link_ys)):
-        (x1, x2, x3, x4), (y1, y2, y3, y4) = xs, ys
-        nx = (x2+x3)/2
-        ny = y2
-        node = _DendNode(nx, ny, i, xs, ys, None, None)
-        _nodes_by_x[nx] = _nodes_by_x.get(nx, []) + [i]
-        _nodes_by_y[ny] = _nodes_by_y.get(ny, []) + [i]
-        nodes_by_i[i] = node
-        nodes.append(node)
-    nodes_by_x: FloatDict[list] = FloatDict(_nodes_by_x)
-    nodes_by_y: FloatDict[list] = FloatDict(_nodes_by_y)
-
-    def get_node_at(x, y):
-        candidates = set(nodes_by_x.Nearest(x) + nodes_by_y.Nearest(y))
-        candidates = [i for i in candidates if nodes_by_i[i].IsAt(x, y)]
-        if len(candidates) == 0: return
-        assert len(candidates) == 1
-        return nodes_by_i[candidates[0]]
-
-    node_parents: dict[_DendNode, _DendNode] = {}
-    for n in nodes:
-        for k, (x, y) in [("left", n.LeftCoords()), ("right", n.RightCoords())]:
-            child = get_node_at(x, y)
-            if child is None: continue
-            setattr(n, k, child)
-            node_parents[child] = n
-
-    _root = None
-    for n in nodes:
-        if n in node_parents: continue
-        assert _root is None
-        _root = n
-    assert _root is not None
-
-    root_dist = _root.y
-    root = DendrogramNode(_root.x, _root.y, _root.i)
-    todo: list[DendrogramNode] = [root]
-    label_index = 0
-    # seen = set()
-    while len(todo) > 0:
-        new = todo.pop()
-        # if new.i in seen: continue
-        # seen.add(new.i)
-        if new.i == -1:
-            new.i = clust_orderi[label_index]
-            new.name = clust_order[label_index]
-            label_index += 1
-            continue
-        _node = nodes_by_i[new.i]
-
-        _ch_coords = [_node.LeftCoords(), _node.RightCoords()]
-        _chl, _chr = sorted(_ch_coords, key=lambda x: x[0], reverse=True) # by x        
-        for ch, (chx, chy) in [("right", _chl), ("left", _chr)]:
-            _child = getattr(_node, ch)
-            if _child is None:
-                new_child = DendrogramNode(chx, chy, -1)
-            else:
-                new_child = DendrogramNode(chx, chy, _child.i)
-            setattr(new, ch, new_child)
-            todo.append(new_child)
-    
-    # ###############################################################
-    # sync matrix order to clustering
+    # build the tree straight from the linkage matrix
 
-    Z = Z[clust_orderi]
-    if metric=="precomputed": Z = Z.T[clust_orderi].T
+    left, right, xs, ys, order = _LinkageTree(linkage_data, count_sort=count_sort, distance_sort=distance_sort)
 
     # ###############################################################
     # order, if given
 
     if sort_order is not None:
-        _pos = {}
-        def update_pos(n: DendrogramNode):
-            if n.i not in _pos:
-                if n.IsLeaf():
-                    _positions = [sort_order[n.i]]
-                    _pos[n.i] = _positions
-                else:
-                    assert n.left is not None
-                    assert n.right is not None
-                    _positions = update_pos(n.left) + update_pos(n.right)
-                    _pos[n.i] = _positions
-                    if n.left.x > n.right.x:
-                        n.left, n.right = n.right, n.left
-            _positions = _pos[n.i]
-            n.x = sum(_positions)/len(_positions)
-            return _pos[n.i]
-        update_pos(root)
+        xs = _SortSubtrees(left, right, linkage_data, sort_order)
 
     # ###############################################################
     # normalize positions
 
-    max_x, min_x, = -np.inf, np.inf
-    max_y, min_y, = -np.inf, np.inf
-    for node in root.Traverse():
-        min_x, max_x = min(min_x, node.x), max(max_x, node.x)
-        min_y, max_y = min(min_y, node.y), max(max_y, node.y)
-    for node in root.Traverse():
-        node.x = float((node.x - min_x) / (max_x - min_x))
-        node.y = float((node.y - min_y) / (max_y - min_y))
+    root_dist = float(ys[-1])
+    xs, ys = _Normalize(xs), _Normalize(ys)
 
-    return LinkageResult(clust_order, clust_orderi, Z[clust_orderi], root, root_dist, linkage_data)
+    peak, quality = None, None
+    if mode == "large":
+        peak = PeakMemory()
+        print(f"clustered {n} in large mode, peak RSS {peak/2**30:.2f} GB")
+    if mode == "approximate" and quality_sample > 1:
+        quality = _CopheneticAgreement(_Z, rep_linkage, assign, method, metric, quality_sample, rng)
+        print(f"clustered {n} through {len(reps)} representatives, cophenetic correlation with exact {quality:.3f}")
+    return LinkageResult(names, order, linkage_data, left, right, xs, ys, root_dist, peak, quality)
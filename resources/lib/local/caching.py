@@ -3,10 +3,26 @@ import pickle
 import gzip
 import json
 import sqlite3
+import hashlib
+import time
+import fcntl
+import uuid
+import atexit
+import threading
+import functools
+import types
+import numpy as np
+import pandas as pd
 from pathlib import Path
-from io import BytesIO
-from typing import Callable, TypeVar
+from collections import OrderedDict
+from contextlib import contextmanager, closing
+from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, TypeVar
 from .constants import EXECUTION_DIR, WORKSPACE_ROOT
+from .utils import batchify
+from .compression import CODECS, write_framed, read_framed
+from . import metrics
 
 ############################## pickling ##############################
 
@@ -23,92 +39,668 @@ def _get_paths(fname: str, alt=None):
     fpath = f'{cache}/{fname}'
     return fpath, cache
 
-def _ext_to_fpaths(fpath: str, compression=False):
-    EXT = '.pkl.gz' if compression else '.pkl'
+def _ext_to_fpaths(fpath: str, compression=False, codec="gzip"):
+    EXT = ('.pkl.gz' if codec == "gzip" else '.pkl.blk') if compression else '.pkl'
     fpath = fpath.replace(EXT, '')
     fpath += EXT
-    fpath_str = fpath.replace(str(WORKSPACE_ROOT), "{WORKSPACE}") # for logging
-    return fpath, fpath_str
+    return fpath, _log_path(fpath)
+
+def _log_path(fpath: str):
+    return fpath.replace(str(WORKSPACE_ROOT), "{WORKSPACE}")
+
+def _find_existing(fpath_no_ext: str):
+    for ext in ENTRY_EXTS:
+        if os.path.isfile(fpath_no_ext+ext): return fpath_no_ext+ext
 
 def save_exists(name: str, alt_workspace=None):
     fpath_no_ext, cache = _get_paths(name, alt_workspace)
-    fpath_comp, fpath_str_comp = _ext_to_fpaths(fpath_no_ext, compression=True)
-    fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=True)
-    return os.path.exists(fpath) or os.path.exists(fpath_comp)
-
-def save(name, x, alt_workspace=None, compression_level=1, silent=False):
+    return _find_existing(fpath_no_ext) is not None
+
+def save(name, x, alt_workspace=None, compression_level=1, silent=False, backend="pickle", background=False, codec="gzip") -> Future|None:
+    """
+    backend:
+        pickle: pickle everything, compressed if compression_level > 0
+        array: numpy arrays as .npy and dataframes as arrow, uncompressed so that
+            load() can memory-map them, dicts of named arrays as .npz,
+            falls back to pickle for anything else
+    background: pickle [x] now, but compress and write it on the background writer,
+        returns a Future, see flush()
+    codec: for compressed pickles
+        gzip: single threaded, readable by anything
+        zlib, lz4: framed blocks (de)compressed on all cores, see local.compression
+    """
+    assert backend in {"pickle", "array"}, backend
+    assert codec == "gzip" or codec in CODECS, codec
     fpath_no_ext, cache = _get_paths(name, alt_workspace)
-    if not os.path.isdir(cache): os.system(f'mkdir {cache}')
-
-    fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=compression_level>0)
+    os.makedirs(os.path.dirname(fpath_no_ext), exist_ok=True)
+    mname = _metric_name(name)
+    fpath = None
+    if backend == "array":
+        t0 = time.perf_counter()
+        fpath = _save_array(fpath_no_ext, x, silent)
+    if fpath is not None: # only timed if it wrote, otherwise the pickle below is the save
+        metrics.observe(mname, "save", time.perf_counter()-t0)
+        _after_write(cache, fpath, mname)
+        # uncompressed, so there is nothing to offload
+        return _done_future() if background else None
+    fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=compression_level>0, codec=codec)
 
     cmsg = 'compressing & ' if compression_level > 0 else ''
-    if not silent: print(f'{cmsg}caching data to [{fpath_str}]')
-
-    if compression_level == 0:
-        with open(fpath, 'wb') as f:
-            pickle.dump(x, f, protocol=pickle.HIGHEST_PROTOCOL)
-    else:
-        with gzip.open(fpath, "wb", compresslevel=compression_level) as f:
-            pickle.dump(x, f, protocol=pickle.HIGHEST_PROTOCOL)
-
+    if not silent: print(f'{cmsg}caching data to [{fpath_str}]{" in background" if background else ""}')
+    if background:
+        t0 = time.perf_counter()
+        def _done(f: Future):
+            if f.exception() is not None: return
+            metrics.observe(mname, "save_background", time.perf_counter()-t0) # includes time queued
+            _after_write(cache, fpath, mname)
+        future = get_background_writer().submit(fpath, x, compression_level, codec)
+        future.add_done_callback(_done)
+        return future
+
+    with metrics.timed(mname, "save"), _atomic_write(fpath) as tmp:
+        if compression_level == 0:
+            with open(tmp, 'wb') as f:
+                pickle.dump(x, f, protocol=pickle.HIGHEST_PROTOCOL)
+        elif codec == "gzip":
+            with gzip.open(tmp, "wb", compresslevel=compression_level) as f:
+                pickle.dump(x, f, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            with open(tmp, 'wb') as f:
+                write_framed(f, pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL), codec, compression_level)
+    _after_write(cache, fpath, mname)
 
-def load(name: str, alt_workspace=None, silent=False):
+def load(name: str, alt_workspace=None, silent=False, mmap=True):
+    # arrays saved with backend="array" are memory-mapped read-only unless [mmap] is False
     fpath_no_ext, cache = _get_paths(name, alt_workspace)
-
-    for c in [False, True]:
-        fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=c)
+    mname = _metric_name(name)
+    for ext in ARRAY_EXTS:
+        if not os.path.isfile(fpath_no_ext+ext): continue
+        CacheIndex(cache).record_hit(fpath_no_ext+ext)
+        metrics.count(mname, "bytes_read", os.path.getsize(fpath_no_ext+ext))
+        with metrics.timed(mname, "load"):
+            return _load_array(fpath_no_ext+ext, silent, mmap)
+
+    for c, codec in [(False, "gzip"), (True, "gzip"), (True, "framed")]:
+        fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=c, codec=codec)
         if not os.path.isfile(fpath): continue
 
+        CacheIndex(cache).record_hit(fpath)
+        metrics.count(mname, "bytes_read", os.path.getsize(fpath))
         dcomp_msg = '& decompressing ' if c else ''
         if not silent: print(f'recovering {dcomp_msg}cached data from [{fpath_str}]')
-        with gzip.open(fpath, "rb") if c else open(fpath, "rb") as f:
-            return pickle.load(f)
+        with metrics.timed(mname, "load"):
+            if codec == "framed": # the codec is recorded in the file's header
+                with open(fpath, "rb") as f:
+                    return pickle.loads(read_framed(f))
+            with gzip.open(fpath, "rb") if c else open(fpath, "rb") as f:
+                return pickle.load(f)
 
     fpath, fpath_str = _ext_to_fpaths(fpath_no_ext)
     raise FileNotFoundError(f"{fpath_str} doesn't exist, nor can a compressed cache be found")
 
-def cache(fname, regenerate, force_regenerate=None, compression_level=1):
+def cache(fname, regenerate, force_regenerate=None, compression_level=1, inputs: list|tuple|None=None, backend="pickle", background=False, codec="gzip"):
+    # if [inputs] are given, the entry is content-addressed by the inputs and [regenerate]
+    # so that a changed input or function yields a new entry instead of a stale one
     if force_regenerate is None: force_regenerate = _force_regenerate
+    mname = _metric_name(fname)
+    if inputs is not None:
+        with metrics.timed(mname, "hash_inputs"):
+            fname = content_path(fname, content_key(regenerate, *inputs))
     fpath_no_ext, cache = _get_paths(fname)
-    fpath, fpath_str = _ext_to_fpaths(fpath_no_ext, compression=compression_level>0)
 
-    if not force_regenerate and os.path.isfile(fpath):
+    if not force_regenerate and _find_existing(fpath_no_ext) is not None:
+        metrics.count(mname, "hits")
         return load(fname)
-    else:
-        x = regenerate()
-        save(fname, x, compression_level=compression_level)
+    # single-flight: the first process to take the lock computes, others wait then load
+    with metrics.timed(mname, "lock_wait"):
+        lock = _acquire_key_lock(fpath_no_ext)
+    try:
+        if not force_regenerate and _find_existing(fpath_no_ext) is not None:
+            metrics.count(mname, "hits")
+            return load(fname)
+        metrics.count(mname, "misses")
+        with metrics.timed(mname, "regenerate"):
+            x = regenerate()
+        saved = save(fname, x, compression_level=compression_level, backend=backend, background=background, codec=codec)
+        if saved is not None: # hold the lock until the background write lands
+            saved.add_done_callback(lambda _, lock=lock: _release_key_lock(lock))
+            lock = None
         return x
+    finally:
+        if lock is not None: _release_key_lock(lock)
+
+############################## process safety ##############################
+
+@contextmanager
+def _atomic_write(fpath: str):
+    # write to a temp file in the same directory, then rename over [fpath],
+    # so that readers never see a partially written file
+    tmp = f"{fpath}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, fpath)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def _acquire_key_lock(fpath_no_ext: str):
+    # advisory lock shared between processes using the same cache dir
+    os.makedirs(os.path.dirname(fpath_no_ext), exist_ok=True)
+    f = open(f"{fpath_no_ext}.lock", "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+def _release_key_lock(f):
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+############################## background writes ##############################
+
+def _done_future(result=None):
+    f = Future()
+    f.set_result(result)
+    return f
+
+class BackgroundWriter:
+    """
+    compresses and writes pickled data on a thread pool
+    the object is pickled in the caller's thread, so it may be modified right after submit()
+    submit() blocks while more than [max_queued_bytes] of pickled data is waiting to be written
+    """
+    def __init__(self, max_workers: int=2, max_queued_bytes: int=2**30) -> None:
+        self.max_queued_bytes = max_queued_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cache_writer")
+        self._queued_bytes = 0
+        self._pending: set[Future] = set()
+        self._cv = threading.Condition()
+
+    def submit(self, fpath: str, x, compression_level=1, codec="gzip") -> Future:
+        data = pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(data)
+        with self._cv:
+            # a single oversized item is still let through once the queue is empty
+            self._cv.wait_for(lambda: self._queued_bytes == 0 or self._queued_bytes+size <= self.max_queued_bytes)
+            self._queued_bytes += size
+            future = self._pool.submit(self._write, fpath, data, compression_level, codec)
+            self._pending.add(future)
+        future.add_done_callback(lambda f: self._on_done(f, size))
+        return future
+
+    @staticmethod
+    def _write(fpath: str, data: bytes, compression_level: int, codec: str):
+        # zlib releases the GIL, so compression overlaps with the caller
+        with _atomic_write(fpath) as tmp, open(tmp, "wb") as f:
+            if compression_level > 0 and codec != "gzip":
+                write_framed(f, data, codec, compression_level)
+                return
+            if compression_level > 0: data = gzip.compress(data, compresslevel=compression_level)
+            f.write(data)
+
+    def _on_done(self, future: Future, size: int):
+        with self._cv:
+            self._queued_bytes -= size
+            self._pending.discard(future)
+            self._cv.notify_all()
+
+    def flush(self):
+        # wait for all queued writes, raises the first error encountered
+        with self._cv:
+            pending = list(self._pending)
+        for f in pending:
+            f.result()
+
+    def close(self):
+        self.flush()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+_background_writer: BackgroundWriter|None = None
+_background_writer_lock = threading.Lock()
+def get_background_writer() -> BackgroundWriter:
+    global _background_writer
+    with _background_writer_lock:
+        if _background_writer is None:
+            _background_writer = BackgroundWriter()
+            atexit.register(_background_writer.close)
+        return _background_writer
+
+def flush():
+    # wait for all saves made with background=True
+    if _background_writer is not None: _background_writer.flush()
+
+############################## memory-mapped arrays ##############################
+
+ARRAY_EXTS = ['.npy', '.npz', '.arrow']
+ENTRY_EXTS = ARRAY_EXTS+['.pkl', '.pkl.gz', '.pkl.blk']
+
+def _save_array(fpath_no_ext: str, x, silent=False) -> str|None:
+    # returns the path written, or None if [x] has no typed array representation, so the caller can pickle it
+    if isinstance(x, np.ndarray) and not x.dtype.hasobject:
+        fpath = fpath_no_ext+'.npy'
+        if not silent: print(f'caching array to [{_log_path(fpath)}]')
+        with _atomic_write(fpath) as tmp, open(tmp, 'wb') as f:
+            np.save(f, x, allow_pickle=False)
+        return fpath
+    if isinstance(x, dict) and len(x) > 0 and all(isinstance(k, str) and isinstance(v, np.ndarray) and not v.dtype.hasobject for k, v in x.items()):
+        fpath = fpath_no_ext+'.npz'
+        if not silent: print(f'caching arrays to [{_log_path(fpath)}]')
+        with _atomic_write(fpath) as tmp, open(tmp, 'wb') as f:
+            np.savez(f, **x)
+        return fpath
+    if isinstance(x, pd.DataFrame):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            return None
+        try:
+            table = pa.Table.from_pandas(x, preserve_index=True)
+        except pa.ArrowException: # e.g. mixed-type object columns
+            return None
+        fpath = fpath_no_ext+'.arrow'
+        if not silent: print(f'caching dataframe to [{_log_path(fpath)}]')
+        with _atomic_write(fpath) as tmp:
+            with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return fpath
+    return None
+
+def _load_array(fpath: str, silent=False, mmap=True):
+    mmap = mmap and not fpath.endswith('.npz') # members of a zip can't be memory-mapped
+    if not silent: print(f'recovering {"memory-mapped " if mmap else ""}cached data from [{_log_path(fpath)}]')
+    if fpath.endswith('.npy'):
+        return np.load(fpath, mmap_mode='r' if mmap else None, allow_pickle=False)
+    if fpath.endswith('.npz'):
+        with np.load(fpath, allow_pickle=False) as f:
+            return {k: f[k] for k in f.files}
+    import pyarrow as pa
+    source = pa.memory_map(fpath, 'r') if mmap else pa.OSFile(fpath, 'rb')
+    table = pa.ipc.open_file(source).read_all()
+    # split_blocks avoids consolidating columns, so numeric columns stay zero-copy views
+    return table.to_pandas(split_blocks=True)
+
+############################## content addressing ##############################
+
+def _fn_identity(fn: Callable, _seen: frozenset=frozenset()):
+    # code, referenced names and constants, plus the state bound to [fn]: closure cells, defaults,
+    # a partial's arguments and a method's instance, so that the same code over different data differs
+    if id(fn) in _seen: return b"recursive"
+    _seen = _seen | {id(fn)}
+    h = hashlib.blake2b(digest_size=20)
+    if isinstance(fn, functools.partial):
+        for x in [fn.func, fn.args, fn.keywords]: _hash_update(h, x, _seen)
+        return b"partial|" + h.digest()
+    fn = getattr(fn, "__wrapped__", fn)
+    name = f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__qualname__)}"
+    h.update(name.encode())
+    bound = getattr(fn, "__self__", None)
+    if bound is not None and not isinstance(bound, types.ModuleType): # bound method
+        _hash_update(h, bound, _seen)
+        fn = getattr(fn, "__func__", fn)
+    code = getattr(fn, "__code__", None)
+    if code is None: # builtins and callable objects
+        state = getattr(fn, "__dict__", None)
+        if isinstance(state, dict): _hash_update(h, state, _seen)
+        return h.digest()
+    todo = [code]
+    while len(todo) > 0: # nested functions/lambdas are part of the identity too
+        c = todo.pop()
+        h.update(c.co_code)
+        h.update("|".join(c.co_names).encode())
+        for k in c.co_consts:
+            if hasattr(k, "co_code"):
+                todo.append(k)
+            else:
+                h.update(repr(k).encode())
+    _hash_update(h, [getattr(fn, "__defaults__", None), getattr(fn, "__kwdefaults__", None)], _seen)
+    for cell in getattr(fn, "__closure__", None) or []:
+        try:
+            v = cell.cell_contents
+        except ValueError: # not yet assigned
+            h.update(b"empty")
+            continue
+        _hash_update(h, v, _seen)
+    return h.digest()
+
+def _hash_file(h, path: Path):
+    if path.is_dir():
+        for p in sorted(path.rglob("*")):
+            if not p.is_file(): continue
+            h.update(str(p.relative_to(path)).encode())
+            _hash_file(h, p)
+        return
+    with open(path, "rb") as f:
+        while chunk := f.read(1<<20):
+            h.update(chunk)
+
+def _hash_update(h, x, _seen: frozenset=frozenset()):
+    # ndarray subclasses, such as memmaps, are hashed as plain arrays
+    h.update(b"ndarray" if isinstance(x, np.ndarray) else type(x).__qualname__.encode())
+    if isinstance(x, np.ndarray):
+        h.update(f"{x.dtype.str}{x.shape}".encode())
+        if x.dtype.hasobject:
+            for v in x.ravel(): _hash_update(h, v, _seen)
+        else:
+            h.update(np.ascontiguousarray(x).reshape(-1).view(np.uint8).data)
+    elif isinstance(x, (pd.DataFrame, pd.Series)):
+        _hash_update(h, np.asarray(x.columns if isinstance(x, pd.DataFrame) else [x.name], dtype=object))
+        h.update(pd.util.hash_pandas_object(x, index=True).to_numpy().data)
+    elif isinstance(x, Path):
+        _hash_file(h, x)
+    elif isinstance(x, (str, bytes, int, float, bool)) or x is None:
+        h.update(repr(x).encode())
+    elif isinstance(x, (list, tuple)):
+        h.update(str(len(x)).encode())
+        for v in x: _hash_update(h, v, _seen)
+    elif isinstance(x, dict):
+        h.update(str(len(x)).encode())
+        for k in sorted(x, key=repr):
+            _hash_update(h, k, _seen)
+            _hash_update(h, x[k], _seen)
+    elif isinstance(x, (set, frozenset)): # pickle writes elements in hash order, which changes between processes
+        h.update(str(len(x)).encode())
+        digests = []
+        for v in x:
+            hv = hashlib.blake2b(digest_size=20)
+            _hash_update(hv, v, _seen)
+            digests.append(hv.digest())
+        for d in sorted(digests): h.update(d)
+    elif callable(x):
+        h.update(_fn_identity(x, _seen))
+    else:
+        h.update(pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL))
+
+def content_key(*inputs) -> str:
+    """
+    hex digest of the contents of [inputs]
+    arrays and dataframes are hashed by value, Paths by file contents, callables by code
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for x in inputs:
+        _hash_update(h, x)
+    return h.hexdigest()
+
+def content_path(fname: str, key: str):
+    # sharded by the first 2 characters of the key to keep directory listings small
+    return f"{fname}/{key[:2]}/{key}"
+
+############################## eviction ##############################
+
+@dataclass
+class CacheEntry:
+    name: str
+    path: str
+    size: int
+    hits: int
+    created: float
+    last_access: float
+
+class CacheIndex:
+    """
+    sidecar sqlite db in the cache dir tracking size, hits and last access of each entry
+    file access times are not trusted since scratch filesystems are often mounted noatime
+    bookkeeping on load and save is best effort, a locked or broken index never fails them
+    """
+    NAME = "_index.db"
+    def __init__(self, cache_dir: str|Path) -> None:
+        self.cache_dir = Path(cache_dir)
+
+    def _connect(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.cache_dir/self.NAME, timeout=60)
+        conn.execute("PRAGMA journal_mode=DELETE") # WAL's shared memory doesn't work on network filesystems
+        conn.execute('''CREATE TABLE IF NOT EXISTS entries
+                        (path TEXT PRIMARY KEY, size INTEGER, hits INTEGER, created REAL, last_access REAL)''')
+        return conn
+
+    def _key(self, fpath: str|Path):
+        return str(Path(fpath).relative_to(self.cache_dir))
+
+    def record_write(self, fpath: str|Path):
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, 0, ?, ?)", (self._key(fpath), os.path.getsize(fpath), now, now))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def record_hit(self, fpath: str|Path):
+        try:
+            with closing(self._connect()) as conn, conn:
+                k = self._key(fpath)
+                cursor = conn.execute("UPDATE entries SET hits=hits+1, last_access=? WHERE path=?", (time.time(), k))
+                if cursor.rowcount == 0: # written before the index existed
+                    st = os.stat(fpath)
+                    conn.execute("INSERT INTO entries VALUES (?, ?, 1, ?, ?)", (k, st.st_size, st.st_mtime, time.time()))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def entries(self) -> list[CacheEntry]:
+        # files on disk are the source of truth, the index only adds stats
+        if not self.cache_dir.is_dir(): return []
+        with closing(self._connect()) as conn, conn:
+            known = {r[0]: r[1:] for r in conn.execute("SELECT path, size, hits, created, last_access FROM entries")}
+            found = []
+            for p in self.cache_dir.rglob("*"):
+                ext = next((e for e in ENTRY_EXTS[::-1] if p.name.endswith(e)), None)
+                if ext is None or not p.is_file(): continue
+                k = self._key(p)
+                if k in known:
+                    size, hits, created, last_access = known.pop(k)
+                else:
+                    st = p.stat()
+                    size, hits, created, last_access = st.st_size, 0, st.st_mtime, max(st.st_atime, st.st_mtime)
+                found.append(CacheEntry(k[:-len(ext)], str(p), size, hits, created, last_access))
+            conn.executemany("DELETE FROM entries WHERE path=?", [(k,) for k in known]) # removed externally
+        return found
+
+    def remove(self, entry: CacheEntry):
+        # the entry's .lock is kept, another process may hold it or be waiting on it
+        if os.path.exists(entry.path): os.remove(entry.path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM entries WHERE path=?", (self._key(entry.path),))
+
+_policy: dict = dict(max_bytes=None, max_age=None)
+def set_cache_policy(max_bytes: int|None=None, max_age: float|None=None):
+    """
+    applied after every write to the cache dir written to, see gc()
+    max_bytes: total size of entries to keep
+    max_age: seconds since last access
+    """
+    _policy.update(max_bytes=max_bytes, max_age=max_age)
+
+def _metric_name(name: str):
+    # content-addressed entries are grouped under the name given to cache()
+    return name.split('/')[0]
+
+def _after_write(cache_dir: str, fpath: str, metric_name: str):
+    CacheIndex(cache_dir).record_write(fpath)
+    metrics.count(metric_name, "bytes_written", os.path.getsize(fpath))
+    if any(v is not None for v in _policy.values()):
+        try:
+            gc(cache_dir=cache_dir, keep={fpath}, silent=True, **_policy)
+        except sqlite3.Error: # retried after the next write
+            pass
+
+def gc(max_bytes: int|None=None, max_age: float|None=None, alt_workspace=None, cache_dir: str|None=None,
+    keep: set[str]=set(), dry_run=False, silent=False) -> list[CacheEntry]:
+    """
+    evicts entries last accessed more than [max_age] seconds ago,
+    then least recently used entries until at most [max_bytes] remain
+    returns the evicted entries
+    """
+    if cache_dir is None: _, cache_dir = _get_paths("", alt_workspace)
+    index = CacheIndex(cache_dir)
+    entries = sorted(index.entries(), key=lambda e: e.last_access)
+    now = time.time()
+    total = sum(e.size for e in entries)
+    evicted = []
+    for e in entries:
+        if e.path in keep: continue
+        expired = max_age is not None and now-e.last_access > max_age
+        over = max_bytes is not None and total > max_bytes
+        if not (expired or over): continue
+        evicted.append(e)
+        total -= e.size
+    for e in evicted:
+        if not silent: print(f"{'would evict' if dry_run else 'evicting'} [{_log_path(e.path)}]")
+        if not dry_run: index.remove(e)
+    return evicted
+
+def list_dict_caches(save_folder: Path|None=None) -> list[Path]:
+    if save_folder is None: save_folder = WORKSPACE_ROOT.joinpath("data/cache")
+    if not save_folder.is_dir(): return []
+    return sorted(save_folder.glob(f"*{DictCache.EXT}"))
+
+def vacuum_dict_caches(save_folder: Path|None=None, silent=False):
+    for p in list_dict_caches(save_folder):
+        before = _db_size(p)
+        with closing(sqlite3.connect(p, timeout=60)) as conn:
+            _vacuum(conn)
+        if not silent: print(f"compacted [{_log_path(str(p))}] {_fmt_bytes(before)} -> {_fmt_bytes(_db_size(p))}")
+
+def _vacuum(conn: sqlite3.Connection):
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+
+def _db_size(p: Path):
+    return sum(os.path.getsize(f) for f in [p, Path(f"{p}-wal")] if f.exists())
+
+def _fmt_bytes(n: float):
+    for unit in ["B", "K", "M", "G"]:
+        if n < 1024: return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}T"
+
+def _parse_bytes(s: str):
+    units = dict(K=2**10, M=2**20, G=2**30, T=2**40)
+    s = s.strip().upper().removesuffix("B")
+    if s and s[-1] in units: return int(float(s[:-1])*units[s[-1]])
+    return int(s)
 
 ############################## fn decorator ##############################
 
 T = TypeVar('T')
-def cache_fn_result(loader: Callable[..., T]) -> Callable[[], T]:
-    data = None
-    def getter(*args, **kargs):
-        nonlocal data
-        if data is None:
-            data = loader(*args, **kargs)
-        return data
-    return getter
+def memoize(maxsize: int|None=128, ttl: float|None=None, disk: str|None=None):
+    """
+    memoizes by the contents of the arguments (see content_key), so arrays are compared by value
+    maxsize: number of results kept in memory, least recently used are dropped first, None for unbounded
+    ttl: seconds a result stays valid
+    disk: name in the on-disk cache to spill results to, so they survive the process
+    concurrent calls with the same arguments share one computation
+    calls with arguments that can't be hashed by content are not memoized
+    """
+    def decorator(fn: Callable[..., T]) -> Callable[..., T]:
+        lock = threading.Lock()
+        results: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        in_flight: dict[str, Future] = {}
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs) -> T:
+            try:
+                key = content_key(fn, args, kwargs)
+            except (TypeError, pickle.PicklingError, AttributeError):
+                return fn(*args, **kwargs)
+
+            with lock:
+                hit = results.get(key)
+                if hit is not None and (ttl is None or time.monotonic()-hit[0] < ttl):
+                    results.move_to_end(key)
+                    return hit[1]
+                future = in_flight.get(key)
+                is_owner = future is None
+                if is_owner: future = in_flight[key] = Future()
+            if not is_owner: return future.result()
+
+            try:
+                if disk is None:
+                    x = fn(*args, **kwargs)
+                else:
+                    fname = content_path(disk, key)
+                    x = cache(fname, lambda: fn(*args, **kwargs), force_regenerate=_is_expired(fname, ttl))
+            except BaseException as e:
+                with lock: in_flight.pop(key)
+                future.set_exception(e)
+                raise
+            with lock:
+                results[key] = time.monotonic(), x
+                results.move_to_end(key)
+                while maxsize is not None and len(results) > maxsize:
+                    results.popitem(last=False)
+                in_flight.pop(key)
+            future.set_result(x)
+            return x
+
+        def cache_clear():
+            with lock: results.clear()
+        setattr(wrapper, "cache_clear", cache_clear)
+        return wrapper
+    return decorator
+
+def _is_expired(fname: str, ttl: float|None):
+    if ttl is None: return False
+    fpath = _find_existing(_get_paths(fname)[0])
+    return fpath is not None and time.time()-os.path.getmtime(fpath) >= ttl
+
+def cache_fn_result(loader: Callable[..., T]) -> Callable[..., T]:
+    # kept for compatibility, results are now keyed by the arguments
+    return memoize(maxsize=None)(loader)
 
 # #####################################################################################
 
 class DictCache:
     EXT = ".db"
-    def __init__(self, name: str, save_folder: Path|None=None, compression: int=9) -> None:
+    MAX_VARS = 900 # stay under SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+    def __init__(self, name: str, save_folder: Path|None=None, compression: int=9,
+        journal_mode: str="WAL", synchronous: str="NORMAL", cache_size: int=-64_000, memory_budget: int=0) -> None:
+        """
+        journal_mode: WAL lets readers proceed during writes, DELETE is the sqlite default
+        synchronous: [OFF, NORMAL, FULL, EXTRA], NORMAL is safe with WAL
+        cache_size: pages if positive, KiB if negative
+        memory_budget: bytes of uncompressed json to keep in an in-process LRU, 0 to disable
+            values are kept serialized, so every hit is a fresh copy that callers may mutate
+        """
         if save_folder is None:
             save_folder = WORKSPACE_ROOT.joinpath(f"data/cache")
             if not save_folder.exists(): os.makedirs(save_folder, exist_ok=True)
         if not name.endswith(self.EXT): name += self.EXT
+        self.name = name.removesuffix(self.EXT)
         # Connect to the SQLite database (or create it if it doesn't exist)
         self.conn = sqlite3.connect(save_folder.joinpath(name))
+        assert journal_mode.upper() in {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}, journal_mode
+        assert synchronous.upper() in {"OFF", "NORMAL", "FULL", "EXTRA"}, synchronous
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        self.conn.execute(f"PRAGMA cache_size={int(cache_size)}")
 
         # Create a table to store the compressed, cached JSON data
         self.conn.execute('''CREATE TABLE IF NOT EXISTS json_cache
                         (id TEXT PRIMARY KEY, data BLOB)''')
         
         self.compression = compression
+        self.memory_budget = memory_budget
+        self._lru: OrderedDict[str, bytes] = OrderedDict()
+        self._lru_bytes = 0
+
+    def _remember(self, key: str, raw: bytes):
+        if key in self._lru: self._lru_bytes -= len(self._lru.pop(key))
+        if len(raw) > self.memory_budget: return
+        self._lru[key] = raw
+        self._lru_bytes += len(raw)
+        while self._lru_bytes > self.memory_budget:
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_bytes -= len(evicted)
+
+    def _recall(self, key: str):
+        raw = self._lru.get(key)
+        if raw is None: return None
+        self._lru.move_to_end(key)
+        metrics.count(self.name, "lru_hits")
+        return (json.loads(raw),) # a tuple, since the value itself may be None
 
     def save(self):
         # Commit the changes to the database
@@ -118,6 +710,10 @@ class DictCache:
         self.conn.commit()
         self.conn.close()
 
+    def vacuum(self):
+        # reclaim space left by replaced values
+        _vacuum(self.conn)
+
     def __enter__(self):
         return self
 
@@ -142,28 +738,77 @@ class DictCache:
         return self.keys()
 
     def __contains__(self, key: str):
-        return self.get(key) is not None
+        if key in self._lru:
+            metrics.count(self.name, "lru_hits")
+            return True
+        cursor = self.conn.execute("SELECT EXISTS(SELECT 1 FROM json_cache WHERE id=?)", (key,))
+        return bool(cursor.fetchone()[0])
+
+    def _encode(self, data) -> tuple[bytes, bytes]:
+        # Serialize the JSON data to a string and compress it using gzip
+        with metrics.timed(self.name, "encode"):
+            raw = json.dumps(data).encode('utf-8')
+            compressed_data = gzip.compress(raw, compresslevel=self.compression)
+        metrics.count(self.name, "bytes_written", len(compressed_data))
+        return compressed_data, raw
+
+    def _decode(self, compressed_data) -> tuple[dict, bytes]:
+        metrics.count(self.name, "bytes_read", len(compressed_data))
+        with metrics.timed(self.name, "decode"):
+            raw = gzip.decompress(compressed_data)
+            return json.loads(raw.decode('utf-8')), raw
+
+    def _decompress(self, compressed_data):
+        return self._decode(compressed_data)[0]
 
     # Define a function to cache JSON data (compressed with gzip)
     def __setitem__(self, key: str, data: dict):
-        # Serialize the JSON data to a string
-        json_data = json.dumps(data)
-        
-        # Compress the JSON data using gzip
-        gzip_buffer = BytesIO()
-        with gzip.GzipFile(mode='wb', fileobj=gzip_buffer, compresslevel=self.compression) as f:
-            f.write(json_data.encode('utf-8'))
-        compressed_data = gzip_buffer.getvalue()
-        
         # Insert or replace the compressed data in the database
+        compressed_data, raw = self._encode(data)
         self.conn.execute("INSERT OR REPLACE INTO json_cache (id, data) VALUES (?, ?)", (key, compressed_data))
-
-    def _decompress(self, compressed_data):
-        gzip_buffer = BytesIO(compressed_data)
-        with gzip.GzipFile(mode='rb', fileobj=gzip_buffer) as f:
-            return json.loads(f.read().decode('utf-8'))
+        if self.memory_budget > 0: self._remember(key, raw)
+
+    def set_many(self, items: dict[str, dict]|Iterable[tuple[str, dict]]):
+        if isinstance(items, dict): items = items.items()
+        def _rows():
+            for k, v in items:
+                compressed_data, raw = self._encode(v)
+                if self.memory_budget > 0: self._remember(k, raw)
+                yield k, compressed_data
+        with self.conn: # single transaction
+            self.conn.executemany("INSERT OR REPLACE INTO json_cache (id, data) VALUES (?, ?)", _rows())
+
+    def get_many(self, keys: Iterable[str], default: dict|None=None) -> dict[str, dict|None]:
+        keys = list(keys)
+        found = {}
+        todo = []
+        for k in keys:
+            hit = self._recall(k)
+            if hit is None:
+                todo.append(k)
+            else:
+                found[k] = hit[0]
+        if len(todo) == 0: return {k: found[k] for k in keys}
+        began = not self.conn.in_transaction
+        if began: self.conn.execute("BEGIN") # one read snapshot for all batches
+        try:
+            for batch in batchify(todo, self.MAX_VARS):
+                params = ",".join("?"*len(batch))
+                cursor = self.conn.execute(f"SELECT id, data FROM json_cache WHERE id IN ({params})", batch)
+                for k, v in cursor:
+                    found[k], raw = self._decode(v)
+                    if self.memory_budget > 0: self._remember(k, raw)
+        finally:
+            if began: self.conn.commit()
+        n_lru = len(keys)-len(todo)
+        metrics.count(self.name, "hits", len(found)-n_lru) # lru hits are counted separately
+        metrics.count(self.name, "misses", len(keys)-len(found))
+        return {k: found.get(k, default) for k in keys}
 
     def get(self, key: str, default: dict|None=None) -> dict|None:
+        hit = self._recall(key)
+        if hit is not None: return hit[0]
+
         # Query the database for the compressed JSON data
         cursor = self.conn.execute("SELECT data FROM json_cache WHERE id=?", (key,))
         
@@ -171,11 +816,15 @@ class DictCache:
         row = cursor.fetchone()
         
         if row is not None:
+            metrics.count(self.name, "hits")
             # Decompress the compressed JSON data
             compressed_data = row[0]
             # Deserialize the JSON data and return it
-            return self._decompress(compressed_data)
+            data, raw = self._decode(compressed_data)
+            if self.memory_budget > 0: self._remember(key, raw)
+            return data
         else:
+            metrics.count(self.name, "misses")
             return default
 
     # Define a function to retrieve cached JSON data
@@ -183,3 +832,39 @@ class DictCache:
         v = self.get(key)
         if v is None: raise KeyError(f"[{key}] not found")
         return v
+
+############################## cli ##############################
+
+def _main():
+    import argparse
+    from datetime import datetime
+    parser = argparse.ArgumentParser(prog="python -m local.caching", description="inspect and prune the lib cache")
+    parser.add_argument("--cache-dir", default=CACHE, help="pickle/array cache, default: [%(default)s]")
+    parser.add_argument("--db-dir", default=None, help=f"DictCache databases, default: [{WORKSPACE_ROOT/'data/cache'}]")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("ls", help="list entries with size, hits and last access")
+    _gc = sub.add_parser("gc", help="evict entries by age, then by LRU down to a size cap")
+    _gc.add_argument("--max-bytes", type=_parse_bytes, default=None, help="e.g. 500M, 20G")
+    _gc.add_argument("--max-age", type=float, default=None, help="days since last access")
+    _gc.add_argument("--dry-run", action="store_true")
+    sub.add_parser("vacuum", help="compact DictCache databases")
+    args = parser.parse_args()
+    db_dir = Path(args.db_dir) if args.db_dir is not None else None
+
+    if args.command == "ls":
+        entries = sorted(CacheIndex(args.cache_dir).entries(), key=lambda e: e.last_access, reverse=True)
+        print(f"{'size':>8} {'hits':>6}  {'last access':<19}  name")
+        for e in entries:
+            print(f"{_fmt_bytes(e.size):>8} {e.hits:>6}  {datetime.fromtimestamp(e.last_access):%Y-%m-%d %H:%M:%S}  {e.name}")
+        print(f"{_fmt_bytes(sum(e.size for e in entries)):>8} total in {len(entries)} entries under [{args.cache_dir}]")
+        for p in list_dict_caches(db_dir):
+            print(f"{_fmt_bytes(_db_size(p)):>8} {'':>6}  {datetime.fromtimestamp(p.stat().st_mtime):%Y-%m-%d %H:%M:%S}  {p}")
+    elif args.command == "gc":
+        max_age = args.max_age*24*60*60 if args.max_age is not None else None
+        evicted = gc(max_bytes=args.max_bytes, max_age=max_age, cache_dir=args.cache_dir, dry_run=args.dry_run)
+        print(f"{'would free' if args.dry_run else 'freed'} {_fmt_bytes(sum(e.size for e in evicted))} from {len(evicted)} entries")
+    elif args.command == "vacuum":
+        vacuum_dict_caches(db_dir)
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,85 @@
+import zlib
+import struct
+from abc import ABC, abstractmethod
+from typing import BinaryIO
+from concurrent.futures import ThreadPoolExecutor
+from .utils import n_threads
+
+# framed block format, so that compression and decompression can use every core
+#   header: MAGIC, codec name, block size, total uncompressed length
+#   then per block: uncompressed length, compressed length, compressed bytes
+MAGIC = b"MSBLK\x00\x01\n"
+_HEADER = struct.Struct("<16sQQ")
+_FRAME = struct.Struct("<II")
+BLOCK_SIZE = 4*2**20
+
+class Codec(ABC):
+    name: str
+    @abstractmethod
+    def compress(self, data, level: int) -> bytes: ...
+    @abstractmethod
+    def decompress(self, data: bytes, raw_len: int) -> bytes: ...
+
+class ZlibCodec(Codec):
+    # deflate is portable and in the standard library, zlib releases the GIL while it works
+    name = "zlib"
+    def compress(self, data, level: int) -> bytes:
+        return zlib.compress(data, level)
+    def decompress(self, data: bytes, raw_len: int) -> bytes:
+        return zlib.decompress(data, bufsize=raw_len)
+
+class Lz4Codec(Codec):
+    # much faster than deflate at a lower ratio, needs the optional lz4 package
+    name = "lz4"
+    def _lib(self):
+        try:
+            import lz4.block
+        except ImportError:
+            raise ImportError("the lz4 codec needs the [lz4] package, use codec=\"zlib\" otherwise")
+        return lz4.block
+    def compress(self, data, level: int) -> bytes:
+        # the level is ignored, this is the fast path
+        return self._lib().compress(data, store_size=False)
+    def decompress(self, data: bytes, raw_len: int) -> bytes:
+        return self._lib().decompress(data, uncompressed_size=raw_len)
+
+CODECS: dict[str, Codec] = {c.name: c for c in [ZlibCodec(), Lz4Codec()]}
+
+def write_framed(f: BinaryIO, data: bytes, codec: str, level: int, block_size: int=BLOCK_SIZE, threads: int|None=None):
+    c = CODECS[codec]
+    view = memoryview(data)
+    blocks = [view[i:i+block_size] for i in range(0, len(view), block_size)]
+    f.write(MAGIC)
+    f.write(_HEADER.pack(codec.encode(), block_size, len(view)))
+    with ThreadPoolExecutor(threads or n_threads()) as pool:
+        for raw, comp in zip(blocks, pool.map(lambda b: c.compress(b, level), blocks)):
+            f.write(_FRAME.pack(len(raw), len(comp)))
+            f.write(comp)
+
+def read_framed(f: BinaryIO, threads: int|None=None) -> bytearray:
+    if f.read(len(MAGIC)) != MAGIC: raise ValueError("not a framed block file")
+    name, block_size, total = _HEADER.unpack(f.read(_HEADER.size))
+    name = name.rstrip(b"\x00").decode()
+    if name not in CODECS: raise ValueError(f"unknown codec [{name}]")
+    c = CODECS[name]
+    frames, offset = [], 0
+    while offset < total:
+        frame = f.read(_FRAME.size)
+        if len(frame) < _FRAME.size: raise ValueError("truncated framed block file")
+        raw_len, comp_len = _FRAME.unpack(frame)
+        comp = f.read(comp_len)
+        if len(comp) < comp_len: raise ValueError("truncated framed block file")
+        frames.append((offset, raw_len, comp))
+        offset += raw_len
+    if offset != total: raise ValueError(f"blocks hold {offset} bytes, the header says {total}")
+
+    out = bytearray(total)
+    def _decompress(frame):
+        offset, raw_len, comp = frame
+        raw = c.decompress(comp, raw_len)
+        # assigning a slice of another length would silently resize [out]
+        if len(raw) != raw_len: raise ValueError(f"block at {offset} decompressed to {len(raw)} bytes, expected {raw_len}")
+        out[offset:offset+raw_len] = raw
+    with ThreadPoolExecutor(threads or n_threads()) as pool:
+        for _ in pool.map(_decompress, frames): pass
+    return out
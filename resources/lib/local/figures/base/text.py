@@ -3,7 +3,7 @@ import numpy as np
 import plotly.graph_objects as go
 from PIL import Image
 
-from ...caching import save_exists, save, load
+from ...caching import save_exists, save, load, memoize
 from .coordinates import rectify_angle, to_cart, rad2deg
 
 class TextPlotter:
@@ -91,6 +91,7 @@ def _render(fig: go.Figure, bounds=None, bg_col="white"):
     )
     return fig
 
+@memoize()
 def GetFontWidths(font_family: str = "default"):
     def _get():
         fig = go.Figure()
@@ -0,0 +1,93 @@
+import zlib
+import struct
+import base64
+import numpy as np
+
+from .template import SubplotSize, go
+from .colors import XColor, ColorObj
+
+def PixelRows(fig: go.Figure, row: int, col: int, ncols: int, scale: float=1) -> int:
+    # pixel height of a subplot as exported with write_image(scale=[scale]), the figure's size and margins must be set
+    _, h = SubplotSize(fig, row, col, ncols)
+    return max(1, int(np.ceil(h*scale)))
+
+def BinRows(z: np.ndarray, n_bins: int, how="mean") -> tuple[np.ndarray, np.ndarray]:
+    """
+    aggregates consecutive rows of [z] into at most [n_bins] bins that differ in size by at most 1, every row is kept
+    how: [mean, max, any], any is 1 where a row in the bin is nonzero
+    returns the binned rows and the index of the first row of each bin
+    """
+    assert how in {"mean", "max", "any"}, how
+    n = len(z)
+    if n == 0: return z, np.zeros(0, dtype=np.int64)
+    n_bins = max(1, min(n_bins, n))
+    starts = np.arange(n_bins)*n//n_bins
+    if how == "max":
+        return np.maximum.reduceat(z, starts, axis=0), starts
+    if how == "any":
+        return (np.add.reduceat(z != 0, starts, axis=0, dtype=np.int64) > 0).astype(np.uint8), starts
+    sizes = np.diff(np.append(starts, n))
+    sums = np.add.reduceat(z, starts, axis=0, dtype=np.float64)
+    return sums/sizes.reshape((-1,)+(1,)*(z.ndim-1)), starts
+
+def _rgba(col: XColor) -> list[float]:
+    if isinstance(col, str) and col.startswith("rgba("):
+        return [float(v) for v in col[5:-1].split(",")]
+    return ColorObj(col).rgba
+
+def ColorMap(z: np.ndarray, colorscale: list, zmin: float, zmax: float) -> np.ndarray:
+    """
+    uint8 RGBA pixels for [z], interpolated between the stops of a plotly style [colorscale]: [[position, color], ...]
+    nan is transparent
+    """
+    stops = np.array([p for p, _ in colorscale], dtype=np.float64)
+    rgba = np.array([_rgba(c) for _, c in colorscale], dtype=np.float64)
+    rgba[:, 3] *= 255
+    t = (np.clip(z, zmin, zmax) - zmin)/(zmax - zmin) if zmax > zmin else np.zeros(z.shape)
+    out = np.empty(z.shape+(4,), dtype=np.uint8)
+    for k in range(4):
+        out[..., k] = np.round(np.interp(np.nan_to_num(t), stops, rgba[:, k]))
+    out[np.isnan(t)] = 0
+    return out
+
+def EncodePNG(rgba: np.ndarray, level: int=6) -> bytes:
+    # an 8 bit RGBA png, without filtering
+    h, w = rgba.shape[:2]
+    raw = np.zeros((h, 1+w*4), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(h, w*4)
+    def _chunk(kind: bytes, data: bytes):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind+data))
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)),
+        _chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+        _chunk(b"IEND", b""),
+    ])
+
+def RasterHeatmap(fig: go.Figure, z: np.ndarray, colorscale: list, zmin: float, zmax: float,
+    row: int, col: int, ncols: int, x: list|None=None, scale: float=1):
+    """
+    draws [z] as an image in a subplot, in place of go.Heatmap(z=z, x=x, ...),
+    so that the output grows with pixels instead of cells
+    cell (i, j) is centered on (j, i), with row 0 at the bottom, and the axes are fixed to the image
+    the cells are repeated up to the subplot's size in pixels, so that they stay sharp instead of being interpolated
+    x: tick labels for the columns
+    """
+    h, w = z.shape
+    w_px, h_px = SubplotSize(fig, row, col, ncols)
+    rgba = ColorMap(z[::-1], colorscale, zmin, zmax)
+    rgba = np.repeat(rgba, max(1, int(np.ceil(h_px*scale/h))), axis=0)
+    rgba = np.repeat(rgba, max(1, int(np.ceil(w_px*scale/w))), axis=1)
+    fig.add_layout_image(
+        dict(
+            source="data:image/png;base64,"+base64.b64encode(EncodePNG(rgba)).decode(),
+            x=-0.5, y=h-0.5, sizex=w, sizey=h,
+            xanchor="left", yanchor="top", sizing="stretch", layer="below",
+        ),
+        row=row, col=col,
+    )
+    fig.update_xaxes(range=[-0.5, w-0.5], row=row, col=col)
+    fig.update_yaxes(range=[-0.5, h-0.5], row=row, col=col)
+    if x is not None:
+        fig.update_xaxes(tickvals=list(range(w)), ticktext=[str(v) for v in x], row=row, col=col)
+    return fig
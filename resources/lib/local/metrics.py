@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+# counters and latency histograms, grouped by the name of the cache they describe
+# set CACHE_METRICS_PATH to have them written as json when the process exits
+
+ENV_PATH = "CACHE_METRICS_PATH"
+BUCKETS = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100] # upper bounds in seconds, plus +inf
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0]*(len(BUCKETS)+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        i = next((i for i, b in enumerate(BUCKETS) if seconds <= b), len(BUCKETS))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return dict(
+            count=self.count, total=self.total,
+            mean=self.total/self.count if self.count else 0.0,
+            min=self.min if self.count else 0.0, max=self.max,
+            buckets={f"le_{b:g}": n for b, n in zip(BUCKETS+[float("inf")], self.counts)},
+        )
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[str, int]] = {}
+        self._histograms: dict[str, dict[str, Histogram]] = {}
+
+    def count(self, name: str, metric: str, n: int=1):
+        with self._lock:
+            c = self._counters.setdefault(name, {})
+            c[metric] = c.get(metric, 0)+n
+
+    def observe(self, name: str, metric: str, seconds: float):
+        with self._lock:
+            self._histograms.setdefault(name, {}).setdefault(metric, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timed(self, name: str, metric: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, metric, time.perf_counter()-t0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            names = sorted(set(self._counters)|set(self._histograms))
+            return {
+                n: dict(
+                    counters=dict(self._counters.get(n, {})),
+                    latency={k: h.to_dict() for k, h in self._histograms.get(n, {}).items()},
+                )
+                for n in names
+            }
+
+    def dump(self, path: str|None=None):
+        if path is None: path = os.environ.get(ENV_PATH)
+        if path is None: return
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+METRICS = Registry()
+count = METRICS.count
+observe = METRICS.observe
+timed = METRICS.timed
+snapshot = METRICS.snapshot
+dump = METRICS.dump
+atexit.register(METRICS.dump)
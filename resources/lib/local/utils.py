@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import os
 import re
 import sys
 from pathlib import Path
@@ -27,6 +28,12 @@ def batchify(iterable, n=1):
     for ndx in range(0, l, n):
         yield iterable[ndx:min(ndx + n, l)]
 
+def n_threads():
+    try:
+        return len(os.sched_getaffinity(0)) # respects cpu limits set by slurm/cgroups
+    except AttributeError:
+        return os.cpu_count() or 1
+
 def add_to_python_path(paths: list[Path|str]):
     if not isinstance(paths, list): paths = [paths]
     sys.path = list(set(sys.path + [str(p) for p in paths]))
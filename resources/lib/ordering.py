@@ -0,0 +1,85 @@
+import os
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import eigsh
+from distances import CrossDistance
+from local.constants import WORKSPACE_ROOT
+
+# 1-D embeddings of the rows of a matrix, for HierarchicalCluster(sort_order=...)
+
+def _Deterministic(v: np.ndarray):
+    # eigenvectors have no inherent sign, so flip them to put the largest entry on the positive side
+    i = np.argmax(np.abs(v))
+    return v if v[i] >= 0 else -v
+
+def PCAOrder(Z: np.ndarray, center=True, block_rows: int=1<<16, **_) -> np.ndarray:
+    """
+    scores on the first principal component, or of the truncated SVD if not [center]
+    the covariance is summed over blocks of rows, so only a (columns x columns) matrix is held
+    """
+    k = Z.shape[1]
+    mean = Z.mean(axis=0, dtype=np.float64) if center else np.zeros(k)
+    cov = np.zeros((k, k))
+    for i0 in range(0, len(Z), block_rows):
+        b = Z[i0:i0+block_rows].astype(np.float64)-mean
+        cov += b.T @ b
+    _, vecs = np.linalg.eigh(cov)
+    v = _Deterministic(vecs[:, -1])
+    scores = np.empty(len(Z))
+    for i0 in range(0, len(Z), block_rows):
+        scores[i0:i0+block_rows] = (Z[i0:i0+block_rows].astype(np.float64)-mean) @ v
+    return scores
+
+def SVDOrder(Z: np.ndarray, **kwargs) -> np.ndarray:
+    return PCAOrder(Z, center=False, **kwargs)
+
+def SpectralOrder(Z: np.ndarray, n_neighbors: int=15, metric="euclidean", seed=0, **_) -> np.ndarray:
+    """
+    the Fiedler vector of the symmetric kNN graph of the rows, with the normalized Laplacian
+    if the graph is not connected, this mostly separates its components
+    neighbours are found exactly, in batches of ~16 MB of distances, so this is O(n^2) in time but not in memory
+    """
+    n = len(Z)
+    k = min(n_neighbors, n-1)
+    if n < 3: return np.zeros(n)
+    batch = max(1, 2**22//n)
+    nbrs = np.empty((n, k), dtype=np.int64)
+    for i0 in range(0, n, batch):
+        d = CrossDistance(Z[i0:i0+batch], Z, metric)
+        d[np.arange(len(d)), np.arange(i0, i0+len(d))] = np.inf
+        nbrs[i0:i0+batch] = np.argpartition(d, k-1, axis=1)[:, :k]
+    W = csr_matrix((np.ones(n*k), (np.repeat(np.arange(n), k), nbrs.ravel())), shape=(n, n))
+    W = ((W + W.T) > 0).astype(np.float64)
+    dinv = diags(1/np.sqrt(np.asarray(W.sum(axis=1)).ravel()))
+    A = dinv @ W @ dinv
+    if n < 100: # too small for arpack
+        _, vecs = np.linalg.eigh(A.toarray())
+        return _Deterministic(dinv @ vecs[:, -2])
+    v0 = np.random.default_rng(seed).random(n)
+    _, vecs = eigsh(A, k=2, which="LA", v0=v0)
+    return _Deterministic(dinv @ vecs[:, 0])
+
+def UMAPOrder(Z: np.ndarray, n_neighbors: int=15, metric="euclidean", seed=0, **_) -> np.ndarray:
+    """
+    a 1-D UMAP embedding, umap is imported only here
+    numba's compiled functions are kept in the workspace's data/cache, with the DictCaches, unless NUMBA_CACHE_DIR is set
+    """
+    os.environ.setdefault("NUMBA_CACHE_DIR", str(WORKSPACE_ROOT.joinpath("data/cache/numba")))
+    from umap import UMAP
+    model = UMAP(n_components=1, n_neighbors=min(n_neighbors, len(Z)-1), metric=metric, transform_seed=seed)
+    return model.fit_transform(Z)[:, 0]
+
+ORDERINGS = {
+    "pca": PCAOrder,
+    "svd": SVDOrder,
+    "spectral": SpectralOrder,
+    "umap": UMAPOrder,
+}
+
+def Order(Z: np.ndarray, method="pca", metric="euclidean", seed=0, **kwargs) -> np.ndarray:
+    """
+    a sort key for each row of [Z]
+    method: [pca, svd, spectral, umap], pca and svd ignore [metric]
+    """
+    assert method in ORDERINGS, f"[{method}] not one of {list(ORDERINGS)}"
+    return ORDERINGS[method](Z, metric=metric, seed=seed, **kwargs)
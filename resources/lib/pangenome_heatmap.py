@@ -1,10 +1,7 @@
 import os
 from pathlib import Path
-import pandas as pd
 import numpy as np
-import sys
-from umap import UMAP
-from sklearn.metrics.pairwise import pairwise_distances
+import argparse
 # ----------------------------------------------------------------------------
 
 from local.figures.base.layout import Canvas, Panel, Transform
@@ -13,49 +10,64 @@ from local.figures.base.text import TextPlotter
 from local.figures.template import BaseFigure, ApplyTemplate, go, SubplotSize
 from local.figures.categorical_bars import CategoricalBar
 from local.figures.colors import Color, Palettes, COLORS
-from hierarchical_clustering import HierarchicalCluster, Deduplicate
+from local.figures.raster import BinRows, PixelRows, RasterHeatmap
+from local.caching import cache
+from hierarchical_clustering import HierarchicalCluster, LinkageResult, Deduplicate
+from distances import ColumnJaccardDistance
+from pangenome_matrix import ReadMatrix
+from ordering import Order, ORDERINGS
 # ----------------------------------------------------------------------------
 
-path_matrix, path_out = sys.argv[1:]
-df = pd.read_csv(path_matrix)
-stability = df["Non-unique Gene name"].to_numpy()
-_left = 14
-xlabels = list(df.columns[_left:])
-for c in xlabels:
-    col = df[c]
-    df[c] = col.apply(lambda v: len(v.split(' "')) if isinstance(v, str) else 0)
-mat = df.iloc[:, _left:].to_numpy()
+# past this many cells, the heatmap is drawn as an embedded image instead of one rect per cell
+RASTER_CELLS = 50_000
+parser = argparse.ArgumentParser()
+parser.add_argument("matrix", help="ppanggolin's matrix.csv")
+parser.add_argument("out", help="image to write")
+parser.add_argument("--render", choices=["auto", "vector", "raster"], default="auto", help=f"heatmap as go.Heatmap or as an image, auto picks raster past {RASTER_CELLS} cells")
+parser.add_argument("--ordering", choices=list(ORDERINGS), default="pca", help="1-D embedding that orders the gene family subtrees, umap is slowest")
+args = parser.parse_args()
+path_matrix, path_out = args.matrix, args.out
+pm = ReadMatrix(path_matrix, keep_metadata=["Gene", "Non-unique Gene name"])
+stability = pm.metadata["Non-unique Gene name"].to_numpy()
+xlabels = pm.genomes
+mat = pm.counts
 print("mat.shape, len(stability), len(xlabels)")
 print(mat.shape, len(stability), len(xlabels))
 # ----------------------------------------------------------------------------
 
-bmat = mat.astype("bool")
-ylabels = list(df["Gene"])
-gmat, gylabels = Deduplicate(bmat, ylabels)
+ylabels = list(pm.metadata["Gene"])
+gmat, gylabels = Deduplicate(mat, ylabels, packed=pm.bits) # by presence, no bool copy of the whole matrix
+gmat = gmat > 0
 print("gmat.shape")
 print(gmat.shape)
 # ----------------------------------------------------------------------------
 
 metric="cosine"
 seed = 42
-model = UMAP(n_components=1, n_neighbors= min(15, len(gmat)-1), metric=metric, transform_seed=seed)
-_emb = model.fit_transform(gmat)
-print("_emb.shape")
-print(_emb.shape)
+_key = cache("order_1d", lambda: Order(gmat, args.ordering, metric=metric, seed=seed), inputs=[gmat, args.ordering, metric, seed], backend="array")
+print(f"_key.shape ({args.ordering})")
+print(_key.shape)
 # ----------------------------------------------------------------------------
 
-gclust = HierarchicalCluster(gmat, gylabels, method="complete", sort_order=_emb[:, 0])
-print("len(gclust.labels), gclust.mat.shape")
-print(len(gclust.labels), gclust.mat.shape)
+# scipy's exact linkage holds n^2/2 float64 distances, past LARGE_N it would not fit the task's memory
+# and past APPROXIMATE_N even the nearest-neighbour chain over float32 distances on disk takes too long
+LARGE_N, APPROXIMATE_N = 20_000, 60_000
+_mode = "exact" if len(gmat) <= LARGE_N else "large" if len(gmat) <= APPROXIMATE_N else "approximate"
+def _cluster_genes():
+    return HierarchicalCluster(gmat, method="complete", sort_order=_key, mode=_mode).ToArrays()
+_arrays = cache("gene_clusters", _cluster_genes, inputs=[gmat, _key, _mode], backend="array") # an uncompressed .npz
+gclust = LinkageResult.FromArrays(_arrays, labels=gylabels)
+print("len(gclust.order)")
+print(len(gclust.order))
 # ----------------------------------------------------------------------------
 
-pdist = pairwise_distances(bmat.T, metric="jaccard")
-clust = HierarchicalCluster(pdist, labels=xlabels, method="complete", metric="precomputed", distance_sort=False)
+pdist = cache("genome_jaccard", lambda: ColumnJaccardDistance(mat), inputs=[pm.bits, mat.shape], backend="array") # condensed, float32, the bits are padded to whole bytes
+clust = HierarchicalCluster(pdist, labels=xlabels, method="complete", metric="precomputed", optimal_ordering=True)
 print("clust.labels")
 print(clust.labels)
 # ----------------------------------------------------------------------------
 
-_gorder = np.array([i for g in gylabels for i in g.groupi])
+_gorder = gylabels.indices # rows grouped by duplicate group
 _gstability = stability[_gorder]
 _new = []
 for i, c in enumerate(["cloud", "shell", "persistent"][::-1]):
@@ -88,26 +100,6 @@ _colorscale = [
     [1, COLORS.RED],
 ]
 
-# anti aliasing
-z = mat.clip(0, 2)[gi][:, clust.order]
-seg = 10
-n_seg = len(z)//seg
-new_len = seg*n_seg
-print(seg, n_seg, new_len)
-z = z[:new_len].reshape((n_seg, z.shape[1], -1))
-z = z.mean(axis=2)
-
-fig.add_trace(
-    go.Heatmap(
-        z = z,
-        zmin=0, zmax=2,
-        x = clust.labels,
-        colorscale=_colorscale,
-        showscale=False,
-    ),
-    row=2, col=1,
-)
-
 BORDER=5
 TSO = 30
 invis = dict(showticklabels=False, linecolor=COLORS.TRANSPARENT, ticks=None)
@@ -129,6 +121,27 @@ fig = ApplyTemplate(
     )
 )
 
+# one row per pixel of the output at most, averaging the gene families that would share it
+z = mat[np.ix_(gi, clust.order)] # a single copy of the matrix, capped in place
+np.minimum(z, 2, out=z)
+z, _ = BinRows(z, PixelRows(fig, 2, 1, COLS), how="mean")
+print("binned z.shape")
+print(z.shape)
+_render = args.render if args.render != "auto" else "raster" if z.size > RASTER_CELLS else "vector"
+if _render == "raster":
+    RasterHeatmap(fig, z, _colorscale, zmin=0, zmax=2, row=2, col=1, ncols=COLS, x=clust.labels)
+else:
+    fig.add_trace(
+        go.Heatmap(
+            z = z,
+            zmin=0, zmax=2,
+            x = clust.labels,
+            colorscale=_colorscale,
+            showscale=False,
+        ),
+        row=2, col=1,
+    )
+
 cvs = Canvas(
     row=1, col=1,
 )
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+from pathlib import Path
+from dataclasses import dataclass
+from distances import ScratchBuffer
+
+# ppanggolin's matrix.csv is in roary's format: 14 columns about each gene family, then one column per genome
+# listing the genes of that family in the genome, separated by ' "'
+METADATA_COLUMNS = 14
+SEPARATOR = ' "'
+
+@dataclass
+class PangenomeMatrix:
+    counts: np.ndarray # uint8, gene families x genomes, copies of each family in each genome, capped at 255
+    bits: np.ndarray # presence as rows of np.packbits, for Deduplicate(..., packed=bits)
+    genomes: list[str]
+    metadata: pd.DataFrame # metadata columns as strings, such as Gene and Non-unique Gene name
+
+def CountCopies(col: pa.Array) -> np.ndarray:
+    """
+    genes listed in each cell of a string column, 0 for empty cells
+    """
+    n = pc.add(pc.count_substring(col, SEPARATOR), 1)
+    n = pc.fill_null(n, 0).to_numpy()
+    return np.minimum(n, 255).astype(np.uint8)
+
+def _CountLines(path: str|Path, chunk_size=1<<24):
+    # an upper bound on the number of rows, quoted newlines would be counted too
+    n, last = 0, b"\n"
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            n += chunk.count(b"\n")
+            last = chunk[-1:]
+    return n + (last != b"\n")
+
+def ReadMatrix(path: str|Path, metadata_columns: int=METADATA_COLUMNS, keep_metadata: list[str]|None=None,
+    block_size: int=1<<21, memmap=False, scratch_dir: str|None=None) -> PangenomeMatrix:
+    """
+    streams [path] through Arrow's csv reader, [block_size] bytes at a time, and writes the copy counts of each block
+    straight into a preallocated matrix, with the presence bitsets for Deduplicate made in the same pass,
+    so that peak memory stays near the size of the result
+    keep_metadata: the metadata columns to keep, default all
+    memmap: put the counts in a ScratchBuffer in [scratch_dir] instead of RAM
+    """
+    names = pacsv.open_csv(path).schema.names # only reads the first block
+    genomes = names[metadata_columns:]
+    meta_names = names[:metadata_columns] if keep_metadata is None else keep_metadata
+
+    n_max = _CountLines(path)-1
+    shape = (n_max, len(genomes))
+    counts = ScratchBuffer(n_max*len(genomes), np.uint8, scratch_dir).reshape(shape) if memmap else np.empty(shape, dtype=np.uint8)
+    bits = np.empty((n_max, (len(genomes)+7)//8), dtype=np.uint8)
+
+    reader = pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in names}, # inferred types could change between blocks
+            include_columns=meta_names+genomes,
+            strings_can_be_null=True,
+        ),
+    )
+    meta, n = [], 0
+    for batch in reader:
+        block = counts[n:n+batch.num_rows]
+        for j, g in enumerate(genomes):
+            block[:, j] = CountCopies(batch.column(g))
+        bits[n:n+batch.num_rows] = np.packbits(block > 0, axis=1)
+        meta.append(batch.select(meta_names))
+        n += batch.num_rows
+    metadata = pa.Table.from_batches(meta, schema=pa.schema([(c, pa.string()) for c in meta_names])).to_pandas()
+    return PangenomeMatrix(counts[:n], bits[:n], genomes, metadata)
@@ -0,0 +1,87 @@
+# rows/sec of DictCache writes and reads, against the implementation before set_many/get_many
+# usage: python bench_dictcache.py [n_rows]
+import sys
+import gzip
+import json
+import time
+import sqlite3
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent/"resources/lib"))
+from local.caching import DictCache
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+
+class BaselineDictCache:
+    # DictCache as it was: sqlite's default pragmas, a GzipFile per row and contains by decoding the value
+    def __init__(self, path: Path, compression: int=9) -> None:
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS json_cache (id TEXT PRIMARY KEY, data BLOB)''')
+        self.compression = compression
+
+    def save(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __setitem__(self, key: str, data: dict):
+        gzip_buffer = BytesIO()
+        with gzip.GzipFile(mode='wb', fileobj=gzip_buffer, compresslevel=self.compression) as f:
+            f.write(json.dumps(data).encode('utf-8'))
+        self.conn.execute("INSERT OR REPLACE INTO json_cache (id, data) VALUES (?, ?)", (key, gzip_buffer.getvalue()))
+
+    def get(self, key: str, default: dict|None=None) -> dict|None:
+        row = self.conn.execute("SELECT data FROM json_cache WHERE id=?", (key,)).fetchone()
+        if row is None: return default
+        with gzip.GzipFile(mode='rb', fileobj=BytesIO(row[0])) as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def __contains__(self, key: str):
+        return self.get(key) is not None
+
+def record(i):
+    return {
+        "accession": f"GCF_{i:09d}.1",
+        "organism": {"name": "Escherichia coli", "tax_id": 562},
+        "assembly": {"level": "Complete Genome", "contigs": i%50+1, "length": 4_600_000+i},
+    }
+
+def timed(label, fn, baseline: float|None=None) -> float:
+    t0 = time.perf_counter()
+    fn()
+    rate = N/(time.perf_counter()-t0)
+    vs = "" if baseline is None else f" {rate/baseline:>8.1f}x baseline"
+    print(f"{label:<44} {rate:>12,.0f} rows/s{vs}")
+    return rate
+
+data = {f"k{i}": record(i) for i in range(N)}
+keys = list(data)
+with tempfile.TemporaryDirectory() as tmp:
+    print("baseline: per-row GzipFile, default pragmas (journal=DELETE, sync=FULL)")
+    db = BaselineDictCache(Path(tmp)/"baseline.db")
+    def _set_each_baseline():
+        for k, v in data.items(): db[k] = v
+        db.save()
+    base_set = timed("  set, one statement per key", _set_each_baseline)
+    base_get = timed("  get, one statement per key", lambda: [db.get(k) for k in keys])
+    base_contains = timed("  contains", lambda: [k in db for k in keys])
+    db.close()
+
+    print("current: gzip.compress, WAL, sync=NORMAL")
+    with DictCache("single", Path(tmp)) as db:
+        def _set_each():
+            for k, v in data.items(): db[k] = v
+            db.save()
+        timed("  set, one statement per key", _set_each, base_set)
+        timed("  get, one statement per key", lambda: [db.get(k) for k in keys], base_get)
+    with DictCache("bulk", Path(tmp)) as db:
+        timed("  set_many", lambda: db.set_many(data), base_set)
+        timed("  get_many", lambda: db.get_many(keys), base_get)
+        timed("  contains", lambda: [k in db for k in keys], base_contains)
+    with DictCache("bulk", Path(tmp), memory_budget=1<<28) as db:
+        db.get_many(keys) # warm
+        timed("  get, in-memory LRU tier", lambda: [db.get(k) for k in keys], base_get)
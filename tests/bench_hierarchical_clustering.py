@@ -0,0 +1,113 @@
+# time per stage of Deduplicate and HierarchicalCluster on synthetic presence/absence matrices
+# each size runs in its own process, so that peak RSS is per size
+# writes [out].json and [out].csv, with the commit, to compare between commits
+# usage: python bench_hierarchical_clustering.py [--sizes 1000,4000,16000] [--genomes 50] [--duplication 0.5] [--out hc_bench]
+import sys
+import csv
+import json
+import time
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+
+LIB = Path(__file__).parent.parent/"resources/lib"
+sys.path.append(str(LIB))
+from hierarchical_clustering import Deduplicate, LinkageResult, PeakMemory, _LinkageTree, _SortSubtrees, _Normalize
+from distances import JaccardDistance
+
+STAGES = ["dedup", "distance", "distance_genomes", "linkage", "tree", "sort_order", "normalization"]
+
+def Synthetic(n_families: int, n_genomes: int, duplication: float, rng: np.random.Generator):
+    """
+    presence/absence of gene families (rows) in genomes (columns), where about [duplication] of the rows
+    repeat another one, half of them the core family present everywhere, as in a real pangenome
+    accessory families follow 8 lineages, with U-shaped frequencies
+    """
+    n_unique = max(2, round(n_families*(1-duplication)))
+    lineage = rng.integers(8, size=n_genomes)
+    freq = rng.beta(0.3, 0.3, size=(n_unique, 8))
+    unique = rng.random((n_unique, n_genomes)) < freq[:, lineage]
+    unique[0] = True
+    n_repeats = n_families-n_unique
+    repeats = np.where(rng.random(n_repeats) < 0.5, 0, rng.integers(n_unique, size=n_repeats))
+    return unique[rng.permutation(np.concatenate([np.arange(n_unique), repeats]))]
+
+def RunOne(n_families: int, n_genomes: int, duplication: float, method: str, seed: int):
+    rng = np.random.default_rng(seed)
+    baseline = PeakMemory()
+    b = Synthetic(n_families, n_genomes, duplication, rng)
+    labels = [f"family_{i}" for i in range(n_families)]
+
+    times = {}
+    def _stage(name, fn):
+        t0 = time.perf_counter()
+        x = fn()
+        times[name] = time.perf_counter()-t0
+        return x
+    g, groups = _stage("dedup", lambda: Deduplicate(b, labels))
+    d = _stage("distance", lambda: pdist(g, metric="euclidean")) # as exact mode does for the gene axis
+    _stage("distance_genomes", lambda: JaccardDistance(b.T))
+    L = _stage("linkage", lambda: linkage(d, method=method))
+    left, right, xs, ys, order = _stage("tree", lambda: _LinkageTree(L))
+    sort_order = rng.random(len(g))
+    xs = _stage("sort_order", lambda: _SortSubtrees(left, right, L, sort_order))
+    _stage("normalization", lambda: LinkageResult(groups, order, L, left, right, _Normalize(xs), _Normalize(ys), float(ys[-1])))
+
+    return dict(
+        n_families=n_families, n_genomes=n_genomes, duplication=duplication, n_unique=len(g), method=method, seed=seed,
+        **{f"{k}_s": times[k] for k in STAGES}, total_s=sum(times.values()),
+        baseline_rss_bytes=baseline, peak_rss_bytes=PeakMemory(),
+    )
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=LIB, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,4000,16000", help="numbers of gene families, comma separated")
+    parser.add_argument("--genomes", type=int, default=50)
+    parser.add_argument("--duplication", type=float, default=0.5, help="fraction of rows that repeat another")
+    parser.add_argument("--method", default="complete")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="hc_bench", help="report path, without extension")
+    parser.add_argument("--one", type=int, default=None, help=argparse.SUPPRESS) # a single size, in this process
+    args = parser.parse_args()
+
+    if args.one is not None:
+        print(json.dumps(RunOne(args.one, args.genomes, args.duplication, args.method, args.seed)))
+        return
+
+    results = []
+    for n in [int(s) for s in args.sizes.split(",")]:
+        cmd = [sys.executable, __file__, "--one", str(n), "--genomes", str(args.genomes),
+            "--duplication", str(args.duplication), "--method", args.method, "--seed", str(args.seed)]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        results.append(r)
+        print(f"{n:>10,} families {r['n_unique']:>10,} unique {r['total_s']:>8.2f} s {r['peak_rss_bytes']/2**20:>8.0f} MB peak | "
+            + " ".join(f"{k} {r[f'{k}_s']:.3f}" for k in STAGES))
+
+    report = dict(
+        commit=_commit(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+        results=results,
+    )
+    with open(f"{args.out}.json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(f"{args.out}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["commit"]+list(results[0]))
+        writer.writeheader()
+        for r in results:
+            writer.writerow(dict(commit=report["commit"])|r)
+    print(f"wrote {args.out}.json and {args.out}.csv")
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,16 @@ model   = Transform()
 image   = model.AddRequirement(lib.GetType("containers::python_for_data_science.oci"))
 clust   = model.AddRequirement(lib.GetType("lib::hierarchical_clustering.py"))
 clust   = model.AddRequirement(lib.GetType("lib::local"))
+dist    = model.AddRequirement(lib.GetType("lib::distances.py"))
+parser  = model.AddRequirement(lib.GetType("lib::pangenome_matrix.py"))
+order   = model.AddRequirement(lib.GetType("lib::ordering.py"))
 script  = model.AddRequirement(lib.GetType("lib::pangenome_heatmap.py"))
 matrix  = model.AddRequirement(lib.GetType("pangenome::ppanggolin_matrix"))
 out     = model.AddProduct(lib.GetType("pangenome::heatmap"))
 
+# numba's compiled functions for umap, kept with the lib's DictCaches since the working dir is per task
+NUMBA_CACHE = Path(__file__).resolve().parents[2].joinpath("resources/data/cache/numba")
+
 def protocol(context: ExecutionContext):
     imatrix=context.Input(matrix)
     iscript=context.Input(script)
@@ -21,6 +27,7 @@ def protocol(context: ExecutionContext):
         mkdir -p ./fake_home/.config
         mkdir -p ./fake_home/.pki
     """)
+    context.LocalShell(f"mkdir -p {NUMBA_CACHE}")
     context.ExecWithContainer(
         image=image,
         binds=[
@@ -28,9 +35,10 @@ def protocol(context: ExecutionContext):
             ("$(pwd -P)/fake_home/.local",  "$HOME/.local"),
             ("$(pwd -P)/fake_home/.config", "$HOME/.config"),
             ("$(pwd -P)/fake_home/.pki",    "$HOME/.pki"),
+            (str(NUMBA_CACHE),              str(NUMBA_CACHE)),
         ],
         cmd=f"""\
-            export NUMBA_CACHE_DIR=$TMPDIR
+            export NUMBA_CACHE_DIR={NUMBA_CACHE}
             python {iscript.container} {imatrix.container} {iout.container}
         """,
     )